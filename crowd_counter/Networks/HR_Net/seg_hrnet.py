@@ -18,20 +18,35 @@ import torch
 import torch.nn as nn
 import torch._utils
 import torch.nn.functional as F
+from torch.ao.nn.quantized import FloatFunctional
+from torch.ao.quantization import (QConfig, DeQuantStub, QuantStub, convert, default_weight_observer,
+                                   fuse_modules, get_default_qconfig, prepare)
 
 BatchNorm2d = nn.BatchNorm2d
 BN_MOMENTUM = 0.01
 logger = logging.getLogger(__name__)
 
 
-def crop(d, g):
-    g_h, g_w = g.size()[2:4]
+def crop(d, size):
+    """Center-crop d to the spatial size (h, w)."""
+    g_h, g_w = size
     d_h, d_w = d.size()[2:4]
     d1 = d[:, :, int(math.floor((d_h - g_h) / 2.0)):int(math.floor((d_h - g_h) / 2.0)) + g_h,
          int(math.floor((d_w - g_w) / 2.0)):int(math.floor((d_w - g_w) / 2.0)) + g_w]
     return d1
 
 
+def fuse_conv_bn_sequentials(module):
+    """Fuse the leading Conv2d+BN(+ReLU) of every nn.Sequential under module, in place."""
+    for seq in list(module.modules()):
+        if isinstance(seq, nn.Sequential) and len(seq) >= 2 \
+                and type(seq[0]) is nn.Conv2d and isinstance(seq[1], nn.BatchNorm2d):
+            names = ['0', '1']
+            if len(seq) > 2 and isinstance(seq[2], nn.ReLU):
+                names.append('2')
+            fuse_modules(seq, [names], inplace=True)
+
+
 def conv3x3(in_planes, out_planes, stride=1):
     """3x3 convolution with padding"""
     return nn.Conv2d(in_planes, out_planes, kernel_size=3, stride=stride,
@@ -50,6 +65,7 @@ class BasicBlock(nn.Module):
         self.bn2 = BatchNorm2d(planes, momentum=BN_MOMENTUM)
         self.downsample = downsample
         self.stride = stride
+        self.add_relu = FloatFunctional()
 
     def forward(self, x):
         residual = x
@@ -63,11 +79,13 @@ class BasicBlock(nn.Module):
         if self.downsample is not None:
             residual = self.downsample(x)
 
-        out += residual
-        out = self.relu(out)
+        out = self.add_relu.add_relu(out, residual)
 
         return out
 
+    def fuse_model(self):
+        fuse_modules(self, [['conv1', 'bn1', 'relu'], ['conv2', 'bn2']], inplace=True)
+
 
 class Bottleneck(nn.Module):
     expansion = 4
@@ -84,8 +102,10 @@ class Bottleneck(nn.Module):
         self.bn3 = BatchNorm2d(planes * self.expansion,
                                momentum=BN_MOMENTUM)
         self.relu = nn.ReLU(inplace=True)
+        self.relu2 = nn.ReLU(inplace=True)
         self.downsample = downsample
         self.stride = stride
+        self.add_relu = FloatFunctional()
 
     def forward(self, x):
         residual = x
@@ -96,7 +116,7 @@ class Bottleneck(nn.Module):
 
         out = self.conv2(out)
         out = self.bn2(out)
-        out = self.relu(out)
+        out = self.relu2(out)
 
         out = self.conv3(out)
         out = self.bn3(out)
@@ -104,11 +124,14 @@ class Bottleneck(nn.Module):
         if self.downsample is not None:
             residual = self.downsample(x)
 
-        out += residual
-        out = self.relu(out)
+        out = self.add_relu.add_relu(out, residual)
 
         return out
 
+    def fuse_model(self):
+        fuse_modules(self, [['conv1', 'bn1', 'relu'], ['conv2', 'bn2', 'relu2'], ['conv3', 'bn3']],
+                     inplace=True)
+
 
 class HighResolutionModule(nn.Module):
     def __init__(self, num_branches, blocks, num_blocks, num_inchannels,
@@ -127,6 +150,9 @@ class HighResolutionModule(nn.Module):
             num_branches, blocks, num_blocks, num_channels)
         self.fuse_layers = self._make_fuse_layers()
         self.relu = nn.ReLU(inplace=True)
+        # One add per output branch so each gets its own observer when quantized
+        self.fuse_adds = nn.ModuleList(
+            [FloatFunctional() for _ in range(len(self.fuse_layers))]) if self.fuse_layers else None
 
     def _check_branches(self, num_branches, blocks, num_blocks,
                         num_inchannels, num_channels):
@@ -240,18 +266,19 @@ class HighResolutionModule(nn.Module):
         x_fuse = []
         for i in range(len(self.fuse_layers)):
             y = x[0] if i == 0 else self.fuse_layers[i][0](x[0])
+            add = self.fuse_adds[i]
             for j in range(1, self.num_branches):
                 if i == j:
-                    y = y + x[j]
+                    y = add.add(y, x[j])
                 elif j > i:
                     width_output = x[i].shape[-1]
                     height_output = x[i].shape[-2]
-                    y = y + F.interpolate(
+                    y = add.add(y, F.interpolate(
                         self.fuse_layers[i][j](x[j]),
                         size=[height_output, width_output],
-                        mode='bilinear')
+                        mode='bilinear'))
                 else:
-                    y = y + self.fuse_layers[i][j](x[j])
+                    y = add.add(y, self.fuse_layers[i][j](x[j]))
             x_fuse.append(self.relu(y))
 
         return x_fuse
@@ -277,6 +304,12 @@ class HighResolutionNet(nn.Module):
                                bias=False)
         self.bn2 = BatchNorm2d(64, momentum=BN_MOMENTUM)
         self.relu = nn.ReLU(inplace=True)
+        self.relu2 = nn.ReLU(inplace=True)
+
+        # Identity in float; quantize/dequantize the input/output after convert()
+        self.quant = QuantStub()
+        self.dequant = DeQuantStub()
+        self.cat = FloatFunctional()
 
         self.stage1_cfg = extra['STAGE1']
         num_channels = self.stage1_cfg['NUM_CHANNELS'][0]
@@ -415,14 +448,15 @@ class HighResolutionNet(nn.Module):
         return nn.Sequential(*modules), num_inchannels
 
     def forward(self, x):
-        gt = x.clone()
+        input_size = x.shape[2:4]
 
+        x = self.quant(x)
         x = self.conv1(x)
         x = self.bn1(x)
         x = self.relu(x)
         x = self.conv2(x)
         x = self.bn2(x)
-        x = self.relu(x)
+        x = self.relu2(x)
         x = self.layer1(x)
 
         x_list = []
@@ -449,21 +483,30 @@ class HighResolutionNet(nn.Module):
                 x_list.append(y_list[i])
         x = self.stage4(x_list)
 
-        # Upsampling
-        x0_h, x0_w = x[0].size(2), x[0].size(3)
-        x1 = F.upsample(x[1], size=(x0_h, x0_w), mode='bilinear')
-        x2 = F.upsample(x[2], size=(x0_h, x0_w), mode='bilinear')
-        x3 = F.upsample(x[3], size=(x0_h, x0_w), mode='bilinear')
-
-        f = torch.cat([x[0], x1, x2, x3], 1)
+        f = self._upsample_concat(x)
 
         x = self.last_layer(f)
+        x = self.dequant(x)
 
-        x = crop(x, gt)
-        # print(x.shape)
+        x = crop(x, input_size)
 
         return x
 
+    def _upsample_concat(self, x):
+        """Upsample every branch to the first branch's size and stack them channel-wise."""
+        size = x[0].shape[2:4]
+        upsampled = [F.interpolate(b, size=size, mode='bilinear', align_corners=False) for b in x[1:]]
+        return self.cat.cat([x[0]] + upsampled, 1)
+
+    def fuse_model(self):
+        """Fuse Conv+BN(+ReLU) in place ahead of static quantization (eval mode only)."""
+        fuse_modules(self, [['conv1', 'bn1', 'relu'], ['conv2', 'bn2', 'relu2']], inplace=True)
+        for m in self.modules():
+            if isinstance(m, (BasicBlock, Bottleneck)):
+                m.fuse_model()
+        # Downsample, transition, fuse and head layers
+        fuse_conv_bn_sequentials(self)
+
     def init_weights(self, pretrained='', train=False):
         logger.info('=> init weights from normal distribution')
         for m in self.modules():
@@ -502,6 +545,42 @@ def get_seg_model(train=False):
     return model
 
 
+def deploy_seg_model(model):
+    """Inference-only HRNet: every BatchNorm folded into the conv before it, in place.
+    
+    Outputs match the eval-mode float model up to float rounding; the result
+    can no longer be trained.
+    """
+    model.eval()
+    model.fuse_model()
+    return model
+
+
+def get_deploy_seg_model():
+    """Folded skeleton to load a deploy state_dict into."""
+    return deploy_seg_model(get_seg_model())
+
+
+def prepare_static_quantization(model, backend='x86'):
+    """Fuse and attach observers; feed calibration images through it, then convert()."""
+    torch.backends.quantized.engine = backend
+    model.eval()
+    model.fuse_model()
+    model.qconfig = get_default_qconfig(backend)
+    # Per-channel weight observers are not supported for ConvTranspose2d
+    per_tensor = QConfig(activation=model.qconfig.activation, weight=default_weight_observer)
+    for m in model.modules():
+        if isinstance(m, nn.ConvTranspose2d):
+            m.qconfig = per_tensor
+    return prepare(model, inplace=True)
+
+
+def get_quantized_seg_model(backend='x86'):
+    """Converted INT8 skeleton to load a quantized state_dict into."""
+    model = prepare_static_quantization(get_seg_model(), backend)
+    return convert(model, inplace=True)
+
+
 if __name__ == '__main__':
     from torchsummary import summary
 
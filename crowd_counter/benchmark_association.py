@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Per-frame cost of the sweep tracker association backends.
+
+Feeds synthetic drifting crowds (with flicker and spurious detections) through
+ImprovedSweepTracker and reports tracker.update() latency per backend.
+
+    python benchmark_association.py --points 100 500 2000 --frames 60
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from live_feed_sweep import ASSOCIATION_BACKENDS, ImprovedSweepTracker
+
+
+def synthetic_frames(num_points, num_frames, width=1920, height=1080, seed=0):
+    rng = np.random.default_rng(seed)
+    pos = rng.random((num_points, 2)) * [width, height]
+    vel = rng.normal(0, 2, (num_points, 2)) + [3, 0]
+    frames = []
+    for _ in range(num_frames):
+        pos = pos + vel + rng.normal(0, 1.5, (num_points, 2))
+        pos[:, 0] %= width
+        pos[:, 1] %= height
+        visible = pos[rng.random(num_points) > 0.15]
+        spurious = rng.random((rng.integers(0, 6), 2)) * [width, height]
+        frames.append(np.round(np.vstack([visible, spurious])).astype(np.int64))
+    return frames
+
+
+def run_backend(frames, association, zone_rect):
+    tracker = ImprovedSweepTracker(max_distance=50, max_age=10, max_lost_age=60, min_hits=3, association=association)
+    timings = []
+    for points in frames:
+        start = time.perf_counter()
+        _, total, _ = tracker.update(points, None, zone_rect)
+        timings.append((time.perf_counter() - start) * 1000)
+    return np.array(timings), total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sweep tracker association benchmark')
+    parser.add_argument('--points', type=int, nargs='+', default=[100, 500, 2000])
+    parser.add_argument('--frames', type=int, default=60)
+    parser.add_argument('--backends', nargs='+', default=list(ASSOCIATION_BACKENDS.keys()),
+                        choices=list(ASSOCIATION_BACKENDS.keys()))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    zone_rect = (100, 100, 1820, 980)
+    print(f"{'points':>7} {'backend':>8} {'mean ms':>9} {'p95 ms':>9} {'max ms':>9} {'total':>7}")
+    for num_points in args.points:
+        frames = synthetic_frames(num_points, args.frames, seed=args.seed)
+        for backend in args.backends:
+            timings, total = run_backend(frames, backend, zone_rect)
+            print(f"{num_points:>7} {backend:>8} {timings.mean():>9.2f} "
+                  f"{np.percentile(timings, 95):>9.2f} {timings.max():>9.2f} {total:>7}")
+
+
+if __name__ == '__main__':
+    main()
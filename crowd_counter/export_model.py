@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Export the HRNet counter to TorchScript, ONNX or a BN-folded deploy checkpoint.
+
+The export is traced at one input size because the crop head's offsets are
+baked in; the batch dimension stays dynamic. Size it from the source frame and
+the --scale used live:
+
+    python export_model.py --model models/model.pth --frame 1920x1080 --scale 0.5 --format onnx
+    python live_feed_sweep.py --model models/model.onnx --scale 0.5 --device cpu ...
+
+The deploy format is an ordinary size-independent checkpoint with every
+BatchNorm folded into its conv; load_model picks it up like any other .pth.
+"""
+
+import argparse
+import copy
+import json
+import os
+import time
+
+import torch
+
+from live_feed_sweep import (
+    EXPORT_META_FILE, SCRIPT_DIR, load_exported_model, load_model,
+)
+
+EXPORT_EXTENSIONS = {'torchscript': '.ts', 'onnx': '.onnx', 'deploy': '_deploy.pth'}
+
+
+def parse_size(text):
+    w, h = text.lower().split('x')
+    return int(w), int(h)
+
+
+def export_torchscript(model, example, output):
+    traced = torch.jit.trace(model, example, check_trace=False)
+    traced = torch.jit.freeze(traced)
+    meta = {'input_size': list(example.shape[2:])}
+    torch.jit.save(traced, output, _extra_files={EXPORT_META_FILE: json.dumps(meta)})
+
+
+def export_onnx(model, example, output, opset):
+    torch.onnx.export(
+        model, example, output,
+        input_names=['image'], output_names=['fidt'],
+        dynamic_axes={'image': {0: 'batch'}, 'fidt': {0: 'batch'}},
+        opset_version=opset, do_constant_folding=True, dynamo=False,
+    )
+
+
+def export_deploy(model, output):
+    from Networks.HR_Net.seg_hrnet import deploy_seg_model
+
+    deployed = deploy_seg_model(copy.deepcopy(model))
+    torch.save({'state_dict': deployed.state_dict(), 'deploy': True}, output)
+
+
+def verify(model, output, runtime, example, runs):
+    """Max abs FIDT difference against eager, plus mean latency of each."""
+    if runtime == 'deploy':
+        exported = load_model(output, device='cpu')
+    else:
+        exported = load_exported_model(output, runtime, 'cpu')
+    with torch.inference_mode():
+        reference = model(example)
+        result = exported(example)
+        timings = {}
+        for name, fn in (('eager', model), (runtime, exported)):
+            # Untimed run: TorchScript profiles and optimizes its graph on the first calls
+            fn(example)
+            start = time.perf_counter()
+            for _ in range(runs):
+                fn(example)
+            timings[name] = (time.perf_counter() - start) * 1000 / max(1, runs)
+    return (reference - result).abs().max().item(), timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export HRNet to TorchScript / ONNX')
+    parser.add_argument('--model', '-m', required=True, help='Checkpoint (.pth)')
+    parser.add_argument('--format', default='onnx', choices=list(EXPORT_EXTENSIONS.keys()))
+    parser.add_argument('--output', '-o', default='', help='Output path (default: next to --model)')
+    parser.add_argument('--frame', default='1920x1080', help='Source frame size WxH')
+    parser.add_argument('--scale', type=float, default=0.5, help='Live --scale the export is sized for')
+    parser.add_argument('--input_size', default='', help='Model input size WxH (overrides --frame/--scale)')
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--verify_runs', type=int, default=3, help='Timed runs when verifying (0 = skip verify)')
+    args = parser.parse_args()
+
+    if args.input_size:
+        in_w, in_h = parse_size(args.input_size)
+    else:
+        frame_w, frame_h = parse_size(args.frame)
+        # Same rounding as GPUPreprocessor
+        in_w, in_h = int(frame_w * args.scale), int(frame_h * args.scale)
+    output = os.path.abspath(args.output or os.path.splitext(args.model)[0] + EXPORT_EXTENSIONS[args.format])
+    model_path = os.path.abspath(args.model)
+
+    # get_seg_model reads its YAML config relative to the crowd_counter folder
+    os.chdir(SCRIPT_DIR)
+    model = load_model(model_path, device='cpu')
+    example = torch.randn(1, 3, in_h, in_w)
+
+    print(f"[Export] {args.format} at {in_w}x{in_h} -> {output}")
+    with torch.inference_mode(False), torch.no_grad():
+        if args.format == 'torchscript':
+            export_torchscript(model, example, output)
+        elif args.format == 'deploy':
+            export_deploy(model, output)
+        else:
+            export_onnx(model, example, output, args.opset)
+    print(f"[Export] Wrote {os.path.getsize(output) / 1e6:.1f} MB")
+
+    if args.verify_runs > 0:
+        max_diff, timings = verify(model, output, args.format, example, args.verify_runs)
+        print(f"[Verify] Max FIDT difference vs eager: {max_diff:.2e}")
+        for name, ms in timings.items():
+            print(f"[Verify] {name:>11}: {ms:.1f} ms/frame")
+
+
+if __name__ == '__main__':
+    main()
@@ -55,6 +55,7 @@ def emit_status(running, message, error=False):
 def map_mode_to_preset(mode):
     mapping = {
         "standard": "accurate",
+        # Single-scale base for multiscale mode; --multiscale adds the other scales
         "multiscale": "accurate",
         "traffic": "sweep",
         "fast": "fast",
@@ -80,14 +81,18 @@ def parse_args():
     parser.add_argument("--scale", type=float)
     parser.add_argument("--threshold", type=float)
     parser.add_argument("--gpu_id", default="0")
+    parser.add_argument("--device", choices=["auto", "cuda", "cpu"])
+    parser.add_argument("--cpu_threads", type=int)
     parser.add_argument("--queue_size", type=int)
     parser.add_argument("--track")
     parser.add_argument("--multiscale")
     parser.add_argument("--detect_interval", type=int)
+    parser.add_argument("--target_fps", type=float)
     parser.add_argument("--max_drift", type=float)
     parser.add_argument("--zone_enabled")
     parser.add_argument("--zone_overlay")
     parser.add_argument("--zone_margin", type=int)
+    parser.add_argument("--zone_infer")
     parser.add_argument("--zone_rect_norm")
     parser.add_argument("--sweep_mode")
     parser.add_argument("--ms_scales")
@@ -123,6 +128,7 @@ def main():
         or str(args.sweep_mode).lower() == "true"
     )
     zone_enabled = str(args.zone_enabled).lower() == "true"
+    multiscale_enabled = (args.mode or "").lower() == "multiscale" or str(args.multiscale).lower() == "true"
 
     translated = [
         "live_feed_sweep.py",
@@ -155,6 +161,8 @@ def main():
         translated.append("--zone")
     if zone_enabled and str(args.zone_overlay).lower() == "true":
         translated.append("--zone_overlay")
+    if str(args.zone_infer).lower() == "true":
+        translated.append("--zone_infer")
     if args.zone_margin is not None:
         translated.extend(["--zone_margin", str(args.zone_margin)])
     if args.zone_rect_norm:
@@ -167,9 +175,20 @@ def main():
         translated.extend(["--box_size", str(args.box_size)])
     if args.detect_interval is not None and args.detect_interval > 0:
         translated.extend(["--skip", str(args.detect_interval)])
+    if args.target_fps is not None and args.target_fps > 0:
+        # --skip then becomes the lowest interval the latency budget may use
+        translated.extend(["--target_fps", str(args.target_fps)])
     if args.max_drift is not None:
         translated.extend(["--max_dist", str(int(args.max_drift))])
-    if args.ms_nms_radius is not None:
+    if multiscale_enabled:
+        translated.append("--multiscale")
+        if args.ms_scales:
+            translated.extend(["--ms_scales", args.ms_scales])
+        if args.ms_threshold is not None:
+            translated.extend(["--ms_threshold", str(args.ms_threshold)])
+        if args.ms_nms_radius is not None:
+            translated.extend(["--ms_nms_radius", str(args.ms_nms_radius)])
+    elif args.ms_nms_radius is not None:
         translated.extend(["--nms", str(args.ms_nms_radius)])
     if args.overlay_style and args.overlay_style.lower() == "dots":
         translated.append("--dot")
@@ -191,6 +210,13 @@ def main():
         translated.extend(["--stream_height", str(args.stream_height)])
     if args.queue_size is not None:
         translated.extend(["--queue_size", str(args.queue_size)])
+    if args.device:
+        translated.extend(["--device", args.device])
+    if args.fp16:
+        # Otherwise the preset's precision policy applies
+        translated.extend(["--precision", "fp16"])
+    if args.cpu_threads is not None:
+        translated.extend(["--cpu_threads", str(args.cpu_threads)])
 
     emit_status(True, "Starting crowd counter")
     sys.argv = translated
@@ -18,6 +18,9 @@ import time
 import json
 import warnings
 import threading
+import itertools
+import collections
+import contextlib
 import queue
 import subprocess
 
@@ -38,42 +41,56 @@ tensor_transform = transforms.ToTensor()
 # PRESETS
 # =============================================================================
 
+# precision / channels_last are the CUDA inference policy; the CPU runs fp32
+# unless --precision asks otherwise
 PRESETS = {
     "fast": {
         "description": "Fast detection",
         "scale": 0.5,
         "threshold": 0.39,
         "nms_kernel": 15,
+        "precision": "fp16",
+        "channels_last": True,
     },
     "accurate": {
         "description": "More accurate",
         "scale": 0.7,
         "threshold": 0.39,
         "nms_kernel": 21,
+        "precision": "fp16",
+        "channels_last": False,
     },
     "sparse": {
         "description": "For sparse crowds (<50)",
         "scale": 0.8,
         "threshold": 0.35,
         "nms_kernel": 31,
+        "precision": "fp16",
+        "channels_last": False,
     },
     "dense": {
         "description": "For large dense crowds (500+)",
         "scale": 0.6,
         "threshold": 0.28,  # Much lower for dense crowds
         "nms_kernel": 13,   # Smaller to avoid over-suppression
+        "precision": "fp16",
+        "channels_last": True,
     },
     "ultra_dense": {
         "description": "For very dense crowds (1000+)",
         "scale": 0.5,
         "threshold": 0.25,  # Very low threshold
         "nms_kernel": 11,   # Minimal suppression
+        "precision": "fp16",
+        "channels_last": True,
     },
     "sweep": {
         "description": "For sweeping large crowds",
         "scale": 0.55,
         "threshold": 0.28,
         "nms_kernel": 11,
+        "precision": "fp16",
+        "channels_last": True,
     },
 }
 
@@ -318,22 +335,14 @@ class DraggableZone:
             return True
         return self.x1 <= x <= self.x2 and self.y1 <= y <= self.y2
     
-    def filter_points(self, kpoint):
-        """Filter keypoints to only those inside zone (vectorized)."""
-        if not self.enabled:
-            return kpoint
-        
-        ys, xs = np.nonzero(kpoint)
-        if len(xs) == 0:
-            return kpoint
+    def filter_points(self, detections):
+        """Filter detections to only those inside zone (vectorized)."""
+        if not self.enabled or len(detections) == 0:
+            return detections
         
-        # Vectorized filtering - much faster than Python loop
+        xs, ys = detections.points[:, 0], detections.points[:, 1]
         mask = (xs >= self.x1) & (xs <= self.x2) & (ys >= self.y1) & (ys <= self.y2)
-        
-        filtered = np.zeros_like(kpoint)
-        filtered[ys[mask], xs[mask]] = 1
-        
-        return filtered
+        return detections.select(mask)
     
     def draw(self, frame=None):
         """Draw zone box on frame."""
@@ -401,15 +410,176 @@ class DraggableZone:
         return (int(self.x1), int(self.y1), int(self.x2), int(self.y2))
 
 
+# =============================================================================
+# SPATIAL HASH
+# =============================================================================
+
+class SpatialHash:
+    """Uniform grid of keyed items for fixed-radius neighbour lookups.
+    
+    With cell_size equal to the query radius, every item within that radius of
+    a point lies in the 3x3 block of cells around it.
+    """
+    
+    def __init__(self, cell_size):
+        self.cell_size = float(cell_size)
+        self.cells = {}
+        self.entries = {}
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def _cell(self, pos):
+        return (int(pos[0] // self.cell_size), int(pos[1] // self.cell_size))
+    
+    def insert(self, key, pos, item):
+        """Add an item, or move it if the key is already indexed."""
+        cell = self._cell(pos)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] != cell:
+            self._discard(key, entry[0])
+        self.cells.setdefault(cell, {})[key] = item
+        self.entries[key] = (cell, item)
+    
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self._discard(key, entry[0])
+    
+    def _discard(self, key, cell):
+        bucket = self.cells[cell]
+        del bucket[key]
+        if not bucket:
+            del self.cells[cell]
+    
+    def clear(self):
+        self.cells = {}
+        self.entries = {}
+    
+    def near(self, pos):
+        """Yield items in the cells neighbouring pos."""
+        cx, cy = self._cell(pos)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                bucket = self.cells.get((cx + dx, cy + dy))
+                if bucket:
+                    yield from bucket.values()
+
+
+# =============================================================================
+# ASSOCIATION
+# =============================================================================
+
+class GreedyAssociation:
+    """Nearest-first greedy matching between detections (rows) and tracks (columns)."""
+    
+    name = 'greedy'
+    
+    def match_pairs(self, dists, gated):
+        """Globally nearest-first over gated pairs; returns (rows, cols) lists."""
+        rows, cols = np.nonzero(gated)
+        order = np.argsort(dists[rows, cols], kind='stable')
+        
+        matched_rows, matched_cols = [], []
+        used_rows, used_cols = set(), set()
+        for r, c in zip(rows[order].tolist(), cols[order].tolist()):
+            if r in used_rows or c in used_cols:
+                continue
+            matched_rows.append(r)
+            matched_cols.append(c)
+            used_rows.add(r)
+            used_cols.add(c)
+        return matched_rows, matched_cols
+    
+    def match_rows(self, dists, gates):
+        """Row by row, take the nearest unused column if it is closer than that column's gate."""
+        matched_rows, matched_cols = [], []
+        if dists.size == 0:
+            return matched_rows, matched_cols
+        
+        remaining = dists.astype(np.float64, copy=True)
+        for r in range(remaining.shape[0]):
+            c = int(np.argmin(remaining[r]))
+            if remaining[r, c] >= gates[c]:
+                continue
+            matched_rows.append(r)
+            matched_cols.append(c)
+            remaining[:, c] = np.inf
+        return matched_rows, matched_cols
+
+
+class OptimalAssociation:
+    """Minimum total distance assignment over gated pairs (scipy linear_sum_assignment).
+    
+    The gated pairs form a sparse bipartite graph; each connected component is
+    solved on its own, which keeps the dense sub-problems small in crowds.
+    """
+    
+    name = 'optimal'
+    
+    def __init__(self):
+        from scipy.optimize import linear_sum_assignment
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+        
+        self._solve = linear_sum_assignment
+        self._coo_matrix = coo_matrix
+        self._connected_components = connected_components
+    
+    def match_pairs(self, dists, gated):
+        rows, cols = np.nonzero(gated)
+        if len(rows) == 0:
+            return [], []
+        
+        n_rows, n_cols = gated.shape
+        graph = self._coo_matrix(
+            (np.ones(len(rows), dtype=np.int8), (rows, n_rows + cols)),
+            shape=(n_rows + n_cols, n_rows + n_cols),
+        )
+        _, labels = self._connected_components(graph, directed=False)
+        
+        components = {}
+        for r in np.unique(rows).tolist():
+            components.setdefault(labels[r], ([], []))[0].append(r)
+        for c in np.unique(cols).tolist():
+            components.setdefault(labels[n_rows + c], ([], []))[1].append(c)
+        
+        matched_rows, matched_cols = [], []
+        for comp_rows, comp_cols in components.values():
+            comp_rows, comp_cols = np.array(comp_rows), np.array(comp_cols)
+            sub_dists = dists[np.ix_(comp_rows, comp_cols)].astype(np.float64)
+            sub_gated = gated[np.ix_(comp_rows, comp_cols)]
+            # An out-of-gate pair must cost more than any set of gated pairs,
+            # so the solver maximizes the number of matches before distance
+            cost = np.where(sub_gated, sub_dists, sub_dists[sub_gated].sum() + 1.0)
+            r, c = self._solve(cost)
+            keep = sub_gated[r, c]
+            matched_rows.extend(comp_rows[r[keep]].tolist())
+            matched_cols.extend(comp_cols[c[keep]].tolist())
+        return matched_rows, matched_cols
+    
+    def match_rows(self, dists, gates):
+        return self.match_pairs(dists, dists < gates[None, :])
+
+
+ASSOCIATION_BACKENDS = {
+    'greedy': GreedyAssociation,
+    'optimal': OptimalAssociation,
+}
+
+
 # =============================================================================
 # IMPROVED SWEEP TRACKER
 # =============================================================================
 
+# Match radius multiplier per track state
+STATE_GATE_FACTOR = {'tentative': 0.9, 'confirmed': 1.0, 'suppressed': 0.8}
+
 class ImprovedSweepTracker: 
     """Tracker that prevents re-counting when detections flicker."""
     
     def __init__(self, max_distance=50, max_age=10, max_lost_age=60,
-                 min_hits=3, grid_size=30, reappear_threshold=80):
+                 min_hits=3, grid_size=30, reappear_threshold=80, association='greedy'):
         self.max_distance = max_distance
         self.max_age = max_age
         self.max_lost_age = max_lost_age
@@ -418,6 +588,7 @@ class ImprovedSweepTracker:
         self.reappear_threshold = reappear_threshold
         self.memory_age = max_lost_age * 6
         self.duplicate_radius = max(20, min(max_distance * 1.25, reappear_threshold * 0.6))
+        self.association = ASSOCIATION_BACKENDS[association]()
         
         self.tracks = []
         self.lost_tracks = []
@@ -432,6 +603,12 @@ class ImprovedSweepTracker:
         self.total_unique = 0
         self.frame_count = 0
         self.grid_history = {}
+        self.viewport_tracks = []
+        
+        # Duplicate lookups go through these instead of scanning every track
+        self.active_index = SpatialHash(self.duplicate_radius)
+        self.lost_index = SpatialHash(self.duplicate_radius)
+        self.memory_index = SpatialHash(self.duplicate_radius)
     
     def reset(self):
         self.tracks = []
@@ -446,6 +623,10 @@ class ImprovedSweepTracker:
         self.total_unique = 0
         self.frame_count = 0
         self.grid_history = {}
+        self.viewport_tracks = []
+        self.active_index.clear()
+        self.lost_index.clear()
+        self.memory_index.clear()
         print("[Sweep] Counter reset!")
     
     def _get_grid_cell(self, x, y):
@@ -471,13 +652,15 @@ class ImprovedSweepTracker:
                 self.grid_history[cell].pop(0)
 
     def _remember_track(self, track):
-        self.track_memory[track['id']] = {
+        memory = {
             'id': track['id'],
             'pos': track['pos'].copy(),
             'velocity': track.get('velocity', np.zeros(2, dtype=np.float32)).copy(),
             'last_seen': self.frame_count,
             'created_frame': track.get('created_frame', self.frame_count),
         }
+        self.track_memory[track['id']] = memory
+        self.memory_index.insert(track['id'], memory['pos'], memory)
     
     def _cleanup_grid_history(self):
         """Periodically clean up old grid history to prevent memory leak."""
@@ -491,11 +674,13 @@ class ImprovedSweepTracker:
             self.grid_history = dict(sorted_cells[:500])
 
         min_frame = self.frame_count - self.memory_age
-        self.track_memory = {
-            track_id: memory
-            for track_id, memory in self.track_memory.items()
-            if memory.get('last_seen', 0) >= min_frame
-        }
+        expired = [
+            track_id for track_id, memory in self.track_memory.items()
+            if memory.get('last_seen', 0) < min_frame
+        ]
+        for track_id in expired:
+            del self.track_memory[track_id]
+            self.memory_index.remove(track_id)
     
     def update(self, points, frame_shape=None, zone_rect=None):
         self.frame_count += 1
@@ -505,14 +690,7 @@ class ImprovedSweepTracker:
         if self.frame_count % 1000 == 0:
             self._cleanup_grid_history()
         
-        for t in self.tracks:
-            t['age'] += 1
-            t['time_since_update'] += 1
-        
-        for t in self.lost_tracks:
-            t['lost_age'] += 1
-        
-        self.lost_tracks = [t for t in self.lost_tracks if t['lost_age'] < self.max_lost_age]
+        self._age_tracks()
         
         if points is None or len(points) == 0:
             self._move_to_lost()
@@ -529,6 +707,7 @@ class ImprovedSweepTracker:
             t['velocity'] = 0.7 * t.get('velocity', np.zeros(2, dtype=np.float32)) + 0.3 * (t['pos'] - previous_pos)
             t['hits'] += 1
             t['time_since_update'] = 0
+            self.active_index.insert(t['id'], t['pos'], t)
             self._update_zone_state(t)
             self._promote_track_if_ready(t)
             self._update_grid(t['id'], t['pos'][0], t['pos'][1])
@@ -546,6 +725,7 @@ class ImprovedSweepTracker:
                 t['time_since_update'] = 0
                 t['lost_age'] = 0
                 t['state'] = 'confirmed'
+                self.active_index.insert(t['id'], t['pos'], t)
                 self._update_zone_state(t)
                 self.tracks.append(t)
                 self._update_grid(t['id'], t['pos'][0], t['pos'][1])
@@ -553,7 +733,8 @@ class ImprovedSweepTracker:
                 unmatched_det.remove(det_idx)
             
             for lost_idx in sorted(rematched_lost, reverse=True):
-                self.lost_tracks.pop(lost_idx)
+                t = self.lost_tracks.pop(lost_idx)
+                self.lost_index.remove(t['id'])
         
         if len(unmatched_det) > 0 and len(self.track_memory) > 0:
             rematched_det, remembered_ids = self._match_memory(points, unmatched_det)
@@ -605,6 +786,23 @@ class ImprovedSweepTracker:
         self._move_to_lost()
         return self._get_results()
 
+    def _age_tracks(self):
+        """Advance track ages by one frame and drop lost tracks that expired."""
+        for t in self.tracks:
+            t['age'] += 1
+            t['time_since_update'] += 1
+        
+        for t in self.lost_tracks:
+            t['lost_age'] += 1
+        
+        still_lost = []
+        for t in self.lost_tracks:
+            if t['lost_age'] < self.max_lost_age:
+                still_lost.append(t)
+            else:
+                self.lost_index.remove(t['id'])
+        self.lost_tracks = still_lost
+
     def _point_in_zone(self, point):
         if not getattr(self, 'zone_rect', None):
             return True
@@ -675,47 +873,35 @@ class ImprovedSweepTracker:
         if len(self.tracks) == 0:
             return [], [], list(range(len(points)))
         
-        track_positions = np.array([
-            t['pos'] + t.get('velocity', np.zeros(2, dtype=np.float32)) * max(1, t['time_since_update'])
-            for t in self.tracks
-        ])
-        candidate_pairs = []
-        for det_idx, pt in enumerate(points):
-            dists = np.linalg.norm(track_positions - pt, axis=1)
-            for trk_idx, dist in enumerate(dists):
-                gate = self._active_gate(self.tracks[trk_idx])
-                if dist <= gate:
-                    candidate_pairs.append((dist, det_idx, trk_idx))
-
-        candidate_pairs.sort(key=lambda item: item[0])
-        matched_det, matched_trk = [], []
-        used_trks = set()
-        used_det = set()
-        
-        for _, det_idx, trk_idx in candidate_pairs:
-            if det_idx in used_det or trk_idx in used_trks:
-                continue
-            matched_det.append(det_idx)
-            matched_trk.append(trk_idx)
-            used_det.add(det_idx)
-            used_trks.add(trk_idx)
+        track_positions = self._predicted_positions()
+        gates = self._active_gates()
         
+        # Cost matrix for every (det, track) pair, gated per track in one pass
+        dists = np.linalg.norm(points[:, None, :] - track_positions[None, :, :], axis=2)
+        matched_det, matched_trk = self.association.match_pairs(dists, dists <= gates[None, :])
+        
+        used_det = set(matched_det)
         unmatched_det = [i for i in range(len(points)) if i not in used_det]
         return matched_det, matched_trk, unmatched_det
 
-    def _active_gate(self, track):
-        base = self.max_distance
-        if track.get('state') == 'tentative':
-            base *= 0.9
-        elif track.get('state') == 'suppressed':
-            base *= 0.8
-        return base * (1.0 + min(1.2, track['time_since_update'] * 0.2))
+    def _predicted_positions(self):
+        """Active track positions extrapolated by velocity over the frames since their last match."""
+        velocities = np.array([t.get('velocity', np.zeros(2, dtype=np.float32)) for t in self.tracks])
+        since_update = np.array([t['time_since_update'] for t in self.tracks])
+        steps = np.maximum(1, since_update).astype(np.float32)[:, None]
+        return np.array([t['pos'] for t in self.tracks]) + velocities * steps
+
+    def _active_gates(self):
+        """Per-track match radius, widened while a track goes unmatched."""
+        base = np.array([self.max_distance * STATE_GATE_FACTOR.get(t.get('state'), 1.0) for t in self.tracks])
+        since_update = np.array([t['time_since_update'] for t in self.tracks])
+        return base * (1.0 + np.minimum(1.2, since_update * 0.2))
 
     def _nearest_occupied_id(self, point, exclude_id=None, include_unconfirmed=False,
                              created_frame=None):
         best_id, best_dist = None, None
 
-        for t in self.tracks:
+        for t in self.active_index.near(point):
             if t['id'] == exclude_id:
                 continue
             if created_frame is not None and t.get('created_frame') == created_frame:
@@ -726,7 +912,7 @@ class ImprovedSweepTracker:
             if dist <= self.duplicate_radius and (best_dist is None or dist < best_dist):
                 best_id, best_dist = t['id'], dist
 
-        for t in self.lost_tracks:
+        for t in self.lost_index.near(point):
             if t['id'] == exclude_id:
                 continue
             if t['id'] not in self.counted_ids:
@@ -736,7 +922,8 @@ class ImprovedSweepTracker:
             if dist <= self.duplicate_radius and (best_dist is None or dist < best_dist):
                 best_id, best_dist = t['id'], dist
 
-        for track_id, memory in self.track_memory.items():
+        for memory in self.memory_index.near(point):
+            track_id = memory['id']
             if track_id == exclude_id or track_id not in self.counted_ids:
                 continue
             if created_frame is not None and memory.get('created_frame') == created_frame:
@@ -783,23 +970,13 @@ class ImprovedSweepTracker:
             t['last_pos'] + t.get('velocity', np.zeros(2, dtype=np.float32)) * max(1, t.get('lost_age', 0))
             for t in self.lost_tracks
         ])
-        rematched_det, rematched_lost = [], []
+        lost_ages = np.array([t.get('lost_age', 0) for t in self.lost_tracks])
+        gates = max(self.reappear_threshold, self.max_distance * 2.5) + np.minimum(80, lost_ages * 2)
         
-        for det_idx in unmatched_det_indices:
-            pt = points[det_idx]
-            dists = np.linalg.norm(lost_positions - pt, axis=1)
-            for best_lost in np.argsort(dists):
-                if best_lost in rematched_lost:
-                    continue
-                gate = max(self.reappear_threshold, self.max_distance * 2.5)
-                gate += min(80, self.lost_tracks[best_lost].get('lost_age', 0) * 2)
-                if dists[best_lost] >= gate:
-                    break
-                rematched_det.append(det_idx)
-                rematched_lost.append(best_lost)
-                break
-        
-        return rematched_det, rematched_lost
+        det_indices = np.asarray(unmatched_det_indices)
+        dists = np.linalg.norm(points[det_indices][:, None, :] - lost_positions[None, :, :], axis=2)
+        rows, rematched_lost = self.association.match_rows(dists, gates)
+        return det_indices[rows].tolist(), rematched_lost
 
     def _find_recent_counted_id(self, point, recent_ids):
         if not recent_ids:
@@ -842,24 +1019,13 @@ class ImprovedSweepTracker:
             m['pos'] + m.get('velocity', np.zeros(2, dtype=np.float32)) * max(1, self.frame_count - m.get('last_seen', self.frame_count))
             for m in memories
         ])
-        rematched_det, remembered_ids, used_memory = [], [], set()
-
-        for det_idx in unmatched_det_indices:
-            pt = points[det_idx]
-            dists = np.linalg.norm(memory_positions - pt, axis=1)
-            for memory_idx in np.argsort(dists):
-                if memory_idx in used_memory:
-                    continue
-                memory_age = self.frame_count - memories[memory_idx].get('last_seen', self.frame_count)
-                gate = max(self.reappear_threshold, self.max_distance * 3.0) + min(120, memory_age * 1.5)
-                if dists[memory_idx] >= gate:
-                    break
-                rematched_det.append(det_idx)
-                remembered_ids.append(memories[memory_idx]['id'])
-                used_memory.add(memory_idx)
-                break
-
-        return rematched_det, remembered_ids
+        memory_ages = np.array([self.frame_count - m.get('last_seen', self.frame_count) for m in memories])
+        gates = max(self.reappear_threshold, self.max_distance * 3.0) + np.minimum(120, memory_ages * 1.5)
+        
+        det_indices = np.asarray(unmatched_det_indices)
+        dists = np.linalg.norm(points[det_indices][:, None, :] - memory_positions[None, :, :], axis=2)
+        rows, cols = self.association.match_rows(dists, gates)
+        return det_indices[rows].tolist(), [memories[i]['id'] for i in cols]
     
     def _create_track(self, point, is_potential_reappear=False, state='tentative',
                       hits=1, track_id=None, velocity=None, duplicate_of=None,
@@ -890,6 +1056,7 @@ class ImprovedSweepTracker:
             'count_suppressed': count_suppressed,
             'duplicate_of': duplicate_of,
         })
+        self.active_index.insert(track_id, point, self.tracks[-1])
         if state == 'confirmed':
             self._count_if_entered_zone(self.tracks[-1])
         self._update_grid(track_id, point[0], point[1])
@@ -898,26 +1065,44 @@ class ImprovedSweepTracker:
         still_active = []
         for t in self.tracks:
             if t['time_since_update'] >= self.max_age:
+                self.active_index.remove(t['id'])
                 if t['state'] == 'confirmed':
                     t['lost_age'] = 0
                     t['last_pos'] = t['pos'].copy()
                     self.lost_tracks.append(t)
+                    self.lost_index.insert(t['id'], t['last_pos'], t)
                     self._remember_track(t)
             else:
                 still_active.append(t)
         self.tracks = still_active
     
     def _get_results(self):
-        confirmed = [t for t in self.tracks if t['state'] == 'confirmed']
-        viewport_tracks = [t for t in confirmed if self._point_in_zone(t['pos'])]
+        viewport_tracks, positions = self._viewport_tracks()
+        self.viewport_tracks = viewport_tracks
         self._update_baseline(viewport_tracks)
         for t in viewport_tracks:
             self._count_if_entered_zone(t)
 
         self.total_unique = self.baseline_count + len(self.entry_counted_ids)
-        positions = np.array([t['pos'] for t in viewport_tracks]) if viewport_tracks else np.array([])
         return len(viewport_tracks), self.total_unique, positions
 
+    def extrapolate(self, steps):
+        """Positions of the last viewport tracks moved `steps` updates along their velocity.
+        
+        Velocity is per update, and tracks that went unmatched are also moved
+        over the updates they missed. steps may be fractional.
+        """
+        if not self.viewport_tracks:
+            return np.array([])
+        return np.array([t['pos'] + t['velocity'] * (t['time_since_update'] + steps) for t in self.viewport_tracks])
+
+    def _viewport_tracks(self):
+        """Confirmed tracks inside the zone, plus their positions as an (N, 2) array."""
+        confirmed = [t for t in self.tracks if t['state'] == 'confirmed']
+        viewport_tracks = [t for t in confirmed if self._point_in_zone(t['pos'])]
+        positions = np.array([t['pos'] for t in viewport_tracks]) if viewport_tracks else np.array([])
+        return viewport_tracks, positions
+
     def _update_baseline(self, viewport_tracks):
         if self.baseline_locked:
             return
@@ -961,93 +1146,900 @@ class ImprovedSweepTracker:
 # =============================================================================
 
 class GPUPreprocessor:
-    def __init__(self, device='cuda'):
+    """BGR uint8 frames to normalized RGB model input on the device.
+    
+    Frames are staged through reused pinned host buffers so the upload is a real
+    async copy, and the BGR->RGB swap, /255 and mean/std run on device as one
+    fused multiply-add per channel. Buffers are kept per input resolution in a
+    ring of `slots`, so steady-state frames allocate nothing; a returned image
+    stays valid until `slots` more frames of its size have been preprocessed.
+    
+    With a copy_stream the upload runs on it and the caller's stream only waits
+    for it before normalizing, so one frame's upload overlaps another's compute.
+    """
+    
+    def __init__(self, device='cuda', slots=2, copy_stream=None):
         self.device = device
-        self.mean = torch.tensor([0.485, 0.456, 0.406], device=device).view(1, 3, 1, 1)
-        self.std = torch.tensor([0.229, 0.224, 0.225], device=device).view(1, 3, 1, 1)
+        self.slots = max(1, slots)
+        self.pinned = str(device).startswith('cuda')
+        self.copy_stream = copy_stream
+        mean = torch.tensor([0.485, 0.456, 0.406])
+        std = torch.tensor([0.229, 0.224, 0.225])
+        # (x / 255 - mean) / std == x * gain + bias
+        self.gain = (1.0 / (255.0 * std)).to(device).view(1, 3, 1, 1)
+        self.bias = (-mean / std).to(device).view(1, 3, 1, 1)
+        self.rings = {}
+        self.lock = threading.Lock()
+    
+    def _ring(self, h, w, new_h, new_w):
+        key = (h, w, new_h, new_w)
+        ring = self.rings.get(key)
+        if ring is None:
+            resize = (new_h, new_w) != (h, w)
+            # Consumed within one call on one stream, so shared by all slots
+            ring = {"next": 0, "rgb": torch.empty((1, 3, h, w), device=self.device) if resize else None, "slots": []}
+            for _ in range(self.slots):
+                slot = {"out": torch.empty((1, 3, new_h, new_w), device=self.device)}
+                if self.pinned:
+                    slot["host"] = torch.empty((h, w, 3), dtype=torch.uint8, pin_memory=True)
+                    slot["upload"] = torch.empty((h, w, 3), dtype=torch.uint8, device=self.device)
+                    slot["uploaded"] = torch.cuda.Event()
+                    slot["normalized"] = torch.cuda.Event()
+                ring["slots"].append(slot)
+            self.rings[key] = ring
+        slot = ring["slots"][ring["next"]]
+        ring["next"] = (ring["next"] + 1) % self.slots
+        return ring, slot
+    
+    def _upload(self, frame, slot):
+        # The previous async upload out of this staging buffer must be done
+        slot["uploaded"].synchronize()
+        np.copyto(slot["host"].numpy(), frame)
+        stream = self.copy_stream or torch.cuda.current_stream()
+        with torch.cuda.stream(stream):
+            # ...and the previous normalize must be done reading the device copy
+            stream.wait_event(slot["normalized"])
+            slot["upload"].copy_(slot["host"], non_blocking=True)
+            slot["uploaded"].record(stream)
+        torch.cuda.current_stream().wait_event(slot["uploaded"])
+        return slot["upload"]
     
     def __call__(self, frame, scale=1.0):
-        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        tensor = torch.from_numpy(frame_rgb).to(self.device, non_blocking=True)
-        tensor = tensor.permute(2, 0, 1).unsqueeze(0).float() / 255.0
+        h, w = frame.shape[:2]
+        new_h, new_w = (int(h * scale), int(w * scale)) if scale != 1.0 else (h, w)
+        with self.lock:
+            ring, slot = self._ring(h, w, new_h, new_w)
+            bgr = self._upload(frame, slot) if self.pinned else torch.from_numpy(frame)
+            
+            # Normalization is per-channel affine, so it commutes with the bilinear resize
+            rgb = slot["out"] if ring["rgb"] is None else ring["rgb"]
+            for c in range(3):
+                torch.addcmul(self.bias[0, c], bgr[:, :, 2 - c], self.gain[0, c], out=rgb[0, c])
+            if self.pinned:
+                slot["normalized"].record()
+            if ring["rgb"] is not None:
+                torch.ops.aten.upsample_bilinear2d.out(rgb, [new_h, new_w], False, None, None, out=slot["out"])
+            return slot["out"]
+
+
+# =============================================================================
+# DETECTIONS
+# =============================================================================
+
+class Detections:
+    """Sparse head detections: (N, 2) x/y points plus the FIDT peak score of each."""
+    
+    def __init__(self, points=None, scores=None):
+        self.points = np.empty((0, 2), dtype=np.int64) if points is None else points
+        self.scores = np.empty(0, dtype=np.float32) if scores is None else scores
+    
+    def __len__(self):
+        return len(self.points)
+    
+    def select(self, mask):
+        """Return the detections where mask is True."""
+        return Detections(self.points[mask], self.scores[mask])
+    
+    def rescale(self, factor, frame_w, frame_h):
+        """Map model-space peaks to frame space, dropping any that fall outside."""
+        if factor == 1.0 or len(self.points) == 0:
+            return self
+        points = (self.points * factor).astype(np.int64)
+        inside = (points[:, 0] < frame_w) & (points[:, 1] < frame_h)
+        points, scores = points[inside], self.scores[inside]
+        if factor < 1.0:
+            # Upscaled inference can map neighbouring peaks onto the same frame pixel
+            flat, first = np.unique(points[:, 1] * frame_w + points[:, 0], return_index=True)
+            points = np.column_stack((flat % frame_w, flat // frame_w))
+            scores = scores[first]
+        return Detections(points, scores)
+    
+    def dedupe(self, radius):
+        """Drop detections within radius (Chebyshev, like the NMS window) of a higher-scoring one."""
+        if len(self.points) < 2 or radius <= 0:
+            return self
+        from scipy.spatial import cKDTree
         
-        if scale != 1.0:
-            h, w = tensor.shape[2], tensor.shape[3]
-            new_h, new_w = int(h * scale), int(w * scale)
-            tensor = F.interpolate(tensor, size=(new_h, new_w), mode='bilinear', align_corners=False)
+        pairs = cKDTree(self.points).query_pairs(radius, p=np.inf, output_type='ndarray')
+        if len(pairs) == 0:
+            return self
         
-        return (tensor - self.mean) / self.std
+        # Greedy by score, only over the points that have a neighbour
+        rank = np.empty(len(self.points), dtype=np.int64)
+        rank[np.argsort(-self.scores, kind='stable')] = np.arange(len(self.points))
+        neighbours = {}
+        for i, j in pairs.tolist():
+            neighbours.setdefault(i, []).append(j)
+            neighbours.setdefault(j, []).append(i)
+        keep = np.ones(len(self.points), dtype=bool)
+        for i in sorted(neighbours, key=rank.__getitem__):
+            if keep[i]:
+                for j in neighbours[i]:
+                    if rank[j] > rank[i]:
+                        keep[j] = False
+        return self.select(keep)
+    
+    def translate(self, dx, dy):
+        """Shift points by (dx, dy), e.g. from a crop back to the full frame."""
+        if dx == 0 and dy == 0:
+            return self
+        return Detections(self.points + (dx, dy), self.scores)
+    
+    def mean_score(self):
+        return float(self.scores.mean()) if len(self.scores) > 0 else 0.0
+    
+    def to_kpoint(self, frame_h, frame_w):
+        """Materialize a dense H x W keypoint map for callers that still need one."""
+        kpoint = np.zeros((frame_h, frame_w), dtype=np.float32)
+        if len(self.points) > 0:
+            kpoint[self.points[:, 1], self.points[:, 0]] = 1
+        return kpoint
 
 
 # =============================================================================
 # NMS
 # =============================================================================
 
-def fast_nms_gpu(fidt_output, threshold=0.39, nms_kernel=21):
-    input_max = torch.max(fidt_output).item()
-    
-    if input_max < 0.1:
-        h, w = fidt_output.shape[2], fidt_output.shape[3]
-        return 0, np.zeros((h, w), dtype=np.float32)
+def nms_peaks_device(fidt_output, threshold=0.39, nms_kernel=21, max_peaks=4096, joint_max=True):
+    """Device half of nms_peaks: (is_peak, flat scores, packed) without any host sync.
     
+    packed is a (2, k) float64 tensor of at most max_peaks (index, score) pairs,
+    unused entries scoring -inf.
+    """
     padding = nms_kernel // 2
     keep = F.max_pool2d(fidt_output, nms_kernel, stride=1, padding=padding)
-    keep = (keep == fidt_output).float()
+    if joint_max:
+        input_max = torch.max(fidt_output)
+    else:
+        input_max = fidt_output.amax(dim=(1, 2, 3), keepdim=True)
+    
+    is_peak = (keep == fidt_output) & (fidt_output >= threshold * input_max) & (input_max >= 0.1)
+    flat = torch.where(is_peak, fidt_output, torch.full_like(fidt_output, float('-inf'))).flatten()
+    
+    k = min(max_peaks, flat.numel())
+    scores, indices = torch.topk(flat, k, sorted=False)
+    return is_peak, flat, torch.stack((indices.double(), scores.double()))
+
+
+def nms_peaks_host(packed, is_peak, flat):
+    """Host half of nms_peaks: row-major (indices, scores) from the copied-back packed array."""
+    valid = np.isfinite(packed[1])
+    
+    if valid.all() and packed.shape[1] < flat.numel():
+        # More peaks than the compact buffer holds - take them all
+        indices = torch.nonzero(is_peak.flatten()).squeeze(1)
+        packed = torch.stack((indices.double(), flat[indices].double())).cpu().numpy()
+        valid = np.ones(packed.shape[1], dtype=bool)
+    
+    # Restore row-major order so downstream matching sees peaks as before
+    indices = packed[0, valid].astype(np.int64)
+    order = np.argsort(indices)
+    return indices[order], packed[1, valid][order].astype(np.float32)
+
+
+def nms_peaks(fidt_output, threshold=0.39, nms_kernel=21, max_peaks=4096, joint_max=True):
+    """Flat (index, score) arrays of every FIDT local max, in row-major order.
+    
+    The max, threshold and peak selection stay on the device and only a compact
+    (index, score) tensor of at most max_peaks entries is copied back, so each
+    call costs a single host sync. The threshold is relative to the max over
+    the whole batch, or to each map's own max when joint_max is False.
+    """
+    is_peak, flat, packed = nms_peaks_device(fidt_output, threshold, nms_kernel, max_peaks, joint_max)
+    return nms_peaks_host(packed.cpu().numpy(), is_peak, flat)
+
+
+def peak_detections(indices, scores, width):
+    """Detections from row-major flat peak indices into a map `width` pixels wide."""
+    return Detections(np.column_stack((indices % width, indices // width)), scores)
+
+
+def fast_nms_gpu(fidt_output, threshold=0.39, nms_kernel=21, max_peaks=4096):
+    """Local-max NMS on a single FIDT map, returning (count, Detections) in model space."""
+    indices, scores = nms_peaks(fidt_output, threshold, nms_kernel, max_peaks)
+    detections = peak_detections(indices, scores, fidt_output.shape[-1])
+    return len(detections), detections
+
+
+def fast_nms_batch(fidt_output, threshold=0.39, nms_kernel=21, max_peaks=4096, joint_max=True):
+    """Local-max NMS on a (B, 1, H, W) batch, returning one Detections per map.
+    
+    With joint_max the batch is thresholded against its joint max, so tiles of
+    one frame behave like that frame; frames of different feeds need False.
+    """
+    indices, scores = nms_peaks(fidt_output, threshold, nms_kernel, max_peaks, joint_max)
+    return batch_peak_detections(indices, scores, fidt_output.shape)
+
+
+def batch_peak_detections(indices, scores, shape):
+    """One Detections per map from flat peak indices into a (B, 1, H, W) batch."""
+    h, w = shape[-2:]
+    batch, pixel = np.divmod(indices, h * w)
+    points = np.column_stack((pixel % w, pixel // w))
+    return [Detections(points[batch == b], scores[batch == b]) for b in range(shape[0])]
+
+
+# =============================================================================
+# TILING
+# =============================================================================
+
+def tile_starts(length, tile, overlap):
+    """Offsets of equal tiles covering [0, length); the last one is pulled back inside."""
+    if length <= tile:
+        return [0]
+    stride = max(1, tile - overlap)
+    count = -(-(length - tile) // stride) + 1
+    return [min(i * stride, length - tile) for i in range(count)]
+
+
+def owned_spans(starts, tile, length):
+    """Split [0, length) between tiles at the middle of each overlap."""
+    bounds = [0] + [(nxt + prev + tile) // 2 for prev, nxt in zip(starts, starts[1:])] + [length]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class TileLayout:
+    """Overlapping tiles over a model-space image, and the region each one owns.
     
-    x = keep * fidt_output
-    x = (x >= threshold * torch.max(fidt_output)).float()
+    Peaks are kept only from the tile that owns their position, which drops the
+    border artefacts of each tile's NMS; a final radius dedupe catches heads
+    split across a seam.
+    """
     
-    return int(torch.sum(x).item()), x.squeeze().cpu().numpy()
+    def __init__(self, width, height, tile, overlap):
+        self.width, self.height = width, height
+        self.tile_w, self.tile_h = min(tile, width), min(tile, height)
+        xs = tile_starts(width, self.tile_w, overlap)
+        ys = tile_starts(height, self.tile_h, overlap)
+        x_spans = owned_spans(xs, self.tile_w, width)
+        y_spans = owned_spans(ys, self.tile_h, height)
+        self.origins = [(x, y) for y in ys for x in xs]
+        self.owned = [(x0, y0, x1, y1) for (y0, y1) in y_spans for (x0, x1) in x_spans]
+        self.x_seams = np.array([x0 for x0, _ in x_spans[1:]])
+        self.y_seams = np.array([y0 for y0, _ in y_spans[1:]])
+    
+    def __len__(self):
+        return len(self.origins)
+    
+    def split(self, image):
+        """(T, C, tile_h, tile_w) batch of tiles from a (1, C, H, W) image."""
+        return torch.cat([image[:, :, y:y + self.tile_h, x:x + self.tile_w] for x, y in self.origins])
+    
+    def merge(self, per_tile, radius):
+        """Stitch per-tile Detections into image-space Detections in row-major order."""
+        points, scores = [], []
+        for (x, y), (x0, y0, x1, y1), detections in zip(self.origins, self.owned, per_tile):
+            p = detections.points + (x, y)
+            owned = (p[:, 0] >= x0) & (p[:, 0] < x1) & (p[:, 1] >= y0) & (p[:, 1] < y1)
+            points.append(p[owned])
+            scores.append(detections.scores[owned])
+        points, scores = np.concatenate(points), np.concatenate(scores)
+        
+        # Only peaks close to a seam can be a head seen by two tiles
+        near_seam = np.zeros(len(points), dtype=bool)
+        for seams, axis in ((self.x_seams, 0), (self.y_seams, 1)):
+            if len(seams) > 0:
+                near_seam |= (np.abs(points[:, axis, None] - seams) <= radius).any(axis=1)
+        if near_seam.any():
+            seam = Detections(points[near_seam], scores[near_seam]).dedupe(radius)
+            points = np.concatenate((points[~near_seam], seam.points))
+            scores = np.concatenate((scores[~near_seam], seam.scores))
+        
+        order = np.lexsort((points[:, 0], points[:, 1]))
+        return Detections(points[order], scores[order])
 
 
 # =============================================================================
 # MODEL
 # =============================================================================
 
-def load_model(model_path, gpu_id="0"):
-    os.environ["CUDA_VISIBLE_DEVICES"] = gpu_id
-    torch.backends.cudnn.benchmark = True
+def load_model(model_path, gpu_id="0", device="cuda", quantized=False, deploy=False):
+    if device == "cuda":
+        os.environ["CUDA_VISIBLE_DEVICES"] = gpu_id
+        torch.backends.cudnn.benchmark = True
     
     print(f"[Model] Loading:  {model_path}")
     
-    from Networks.HR_Net.seg_hrnet import get_seg_model
-    
-    model = get_seg_model()
-    model = nn.DataParallel(model, device_ids=[0]).cuda()
+    from Networks.HR_Net.seg_hrnet import (
+        deploy_seg_model, get_deploy_seg_model, get_quantized_seg_model, get_seg_model,
+    )
     
     checkpoint = torch.load(model_path, map_location="cpu")
-    model.load_state_dict(checkpoint.get("state_dict", checkpoint), strict=False)
+    state_dict = checkpoint.get("state_dict", checkpoint)
+    # Checkpoints are saved from DataParallel; the bare module needs the prefix dropped
+    state_dict = {k[len("module."):] if k.startswith("module.") else k: v for k, v in state_dict.items()}
+    
+    if quantized:
+        # INT8 checkpoints from quantize_model.py; quantized kernels are CPU-only
+        if not checkpoint.get("quantized"):
+            raise ValueError(f"{model_path} is not a quantized checkpoint (see quantize_model.py)")
+        model = get_quantized_seg_model(checkpoint.get("backend", "x86"))
+        model.load_state_dict(state_dict)
+        model.eval()
+        print(f"[Model] Loaded INT8 ({checkpoint.get('backend', 'x86')})")
+        return model
+    
+    if checkpoint.get("deploy"):
+        # Already folded by export_model.py --format deploy
+        model = get_deploy_seg_model()
+        model.load_state_dict(state_dict)
+    else:
+        model = get_seg_model()
+        model.load_state_dict(state_dict, strict=False)
+        if deploy:
+            deploy_seg_model(model)
+    
+    if device == "cuda":
+        model = nn.DataParallel(model, device_ids=[0]).cuda()
     model.eval()
     
+    print("[Model] Loaded successfully" + (" (BN folded)" if deploy or checkpoint.get("deploy") else ""))
+    return model
+
+
+# Exported artifacts are traced at one input size (crop offsets are baked in);
+# the batch dimension stays free.
+EXPORT_META_FILE = "meta.json"
+
+RUNTIME_EXTENSIONS = {
+    ".onnx": "onnx",
+    ".ts": "torchscript",
+    ".torchscript": "torchscript",
+}
+
+
+def resolve_runtime(runtime, model_path):
+    if runtime == "auto":
+        return RUNTIME_EXTENSIONS.get(os.path.splitext(model_path)[1].lower(), "eager")
+    return runtime
+
+
+def check_input_size(input_size, image):
+    if input_size and tuple(image.shape[2:]) != tuple(input_size):
+        raise ValueError(
+            f"Exported model expects {input_size[1]}x{input_size[0]} input, got "
+            f"{image.shape[3]}x{image.shape[2]}; re-export at this size or change --scale"
+        )
+
+
+class TorchScriptModel:
+    """Traced HRNet loaded with torch.jit; no model code or YAML config needed."""
+    
+    def __init__(self, path, device="cpu"):
+        extra_files = {EXPORT_META_FILE: ""}
+        self.module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+        self.module.eval()
+        meta = json.loads(extra_files[EXPORT_META_FILE] or "{}")
+        self.input_size = tuple(meta["input_size"]) if "input_size" in meta else None
+    
+    def __call__(self, image):
+        check_input_size(self.input_size, image)
+        return self.module(image)
+
+
+class OnnxRuntimeModel:
+    """ONNX export run through an onnxruntime session (CUDA provider when available)."""
+    
+    def __init__(self, path, device="cpu", num_threads=0):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError("ONNX models need onnxruntime (pip install onnxruntime)") from e
+        
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        providers = ["CPUExecutionProvider"]
+        if device == "cuda" and "CUDAExecutionProvider" in ort.get_available_providers():
+            providers.insert(0, "CUDAExecutionProvider")
+        
+        self.session = ort.InferenceSession(path, options, providers=providers)
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        spatial = model_input.shape[2:]
+        self.input_size = tuple(spatial) if all(isinstance(d, int) for d in spatial) else None
+        print(f"[Model] ONNX providers: {', '.join(self.session.get_providers())}")
+    
+    def __call__(self, image):
+        check_input_size(self.input_size, image)
+        fidt = self.session.run(None, {self.input_name: image.detach().float().cpu().numpy()})[0]
+        return torch.from_numpy(fidt).to(image.device)
+
+
+def load_exported_model(model_path, runtime, device="cpu", num_threads=0):
+    print(f"[Model] Loading {runtime}:  {model_path}")
+    if runtime == "onnx":
+        model = OnnxRuntimeModel(model_path, device, num_threads)
+    else:
+        model = TorchScriptModel(model_path, device)
     print("[Model] Loaded successfully")
     return model
 
 
+def bucket_shape(h, w, multiple=64):
+    """(h, w) rounded up to the next multiple, so nearby sizes share one input shape."""
+    return -(-h // multiple) * multiple, -(-w // multiple) * multiple
+
+
+# Per-side input sizes for inputs that match no registered bucket (zone crops,
+# scale changes); each step wastes at most ~25% of a side on padding, and
+# padding can shift peaks near the right and bottom edges slightly.
+INPUT_LADDER = (64, 128, 192, 256, 320, 384, 448, 512, 640, 768, 896, 1024, 1280, 1536, 1792, 2048, 2560, 3072, 3840)
+
+# Registered buckets are used while they add at most this much area
+MAX_BUCKET_PADDING = 1.25
+
+
+def ladder_size(n):
+    return next((size for size in INPUT_LADDER if size >= n), -(-n // 256) * 256)
+
+
+def resolve_device(device):
+    if device == "auto":
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    return device
+
+
+def configure_cpu_threads(num_threads=0):
+    """Use num_threads intra-op threads (0 = every core) and one inter-op thread."""
+    num_threads = num_threads or os.cpu_count() or 1
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set once per process
+        pass
+    return num_threads
+
+
 # =============================================================================
 # INFERENCE
 # =============================================================================
 
-def run_inference(model, preprocessor, frame, scale=0.5, threshold=0.39, nms_kernel=21):
-    src_h, src_w = frame.shape[:2]
-    image = preprocessor(frame, scale)
-    
-    with torch.inference_mode():
-        with torch.cuda.amp.autocast(dtype=torch.float16):
-            fidt = model(image)
-        count, kpoint_small = fast_nms_gpu(fidt.float(), threshold, nms_kernel)
-    
-    if scale != 1.0:
-        inv_scale = 1.0 / scale
-        kpoint = np.zeros((src_h, src_w), dtype=np.float32)
-        ys, xs = np.nonzero(kpoint_small)
-        for y, x in zip(ys, xs):
-            oy, ox = int(y * inv_scale), int(x * inv_scale)
-            if 0 <= oy < src_h and 0 <= ox < src_w:
-                kpoint[oy, ox] = 1
+PRECISION_DTYPES = {
+    "fp32": None,
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+}
+
+COMPILE_MODES = ["off", "default", "reduce-overhead", "max-autotune"]
+
+
+def precision_policy(args, preset, device):
+    """(precision, channels_last, compile mode): the CLI where given, else the preset on CUDA."""
+    on_cuda = device == "cuda"
+    precision = args.precision or (preset.get("precision", "fp16") if on_cuda else "fp32")
+    if precision == "fp16" and not on_cuda:
+        print("[Model] fp16 autocast is CUDA-only, using fp32 on CPU")
+        precision = "fp32"
+    if precision == "bf16" and on_cuda and not torch.cuda.is_bf16_supported():
+        print("[Model] This GPU has no bf16 support, using fp16")
+        precision = "fp16"
+    if args.channels_last:
+        channels_last = args.channels_last == "on"
     else:
-        kpoint = kpoint_small
+        channels_last = on_cuda and preset.get("channels_last", False)
+    return precision, channels_last, args.compile or preset.get("compile", "off")
+
+
+class PendingResult:
+    """A (count, Detections) whose peaks may still be copying back from the device.
+    
+    result() blocks until the copy has landed; ready() polls without blocking.
+    """
+    
+    def __init__(self, finish, event=None):
+        self.finish = finish
+        self.event = event
+    
+    def ready(self):
+        return self.event is None or self.event.query()
+    
+    def result(self):
+        if self.event is not None:
+            self.event.synchronize()
+        return self.finish()
+
+
+class InferenceEngine:
+    """HRNet forward pass plus NMS on one device at one precision.
+    
+    On CUDA with streams enabled, uploads run on a copy stream and peak
+    downloads on a download stream around the default compute stream, so
+    detect_async() can queue frame N's forward while frame N+1 uploads and
+    frame N-1's peaks copy back.
+    """
+    
+    def __init__(self, model, device="cuda", precision="fp16", channels_last=False,
+                 tile=0, tile_overlap=64, tile_batch=4, bucketing=True, staging_slots=2, streams=True):
+        self.model = model
+        self.device = device
+        self.precision = precision
+        self.channels_last = channels_last
+        # Uncompiled model, kept for the fp32 reference and as the fallback
+        self.eager_model = self.model
+        self.streams = streams and device == "cuda"
+        self.copy_stream = torch.cuda.Stream() if self.streams else None
+        self.download_stream = torch.cuda.Stream() if self.streams else None
+        # Enough slots to cover every preprocessed image still queued or in flight
+        self.preprocessor = GPUPreprocessor(device, staging_slots, self.copy_stream)
+        # Pinned peak buffers detect_async downloads into, a ring per shape; the same
+        # count covers every result still waiting to be collected
+        self.download_slots = max(1, staging_slots)
+        self.downloads = {}
+        if channels_last and isinstance(model, nn.Module):
+            self.model = self.model.to(memory_format=torch.channels_last)
+        
+        # Tiled mode: model-space tile size (0 = whole image), overlap and tiles per forward
+        self.tile = tile
+        self.tile_overlap = tile_overlap
+        self.tile_batch = max(1, tile_batch)
+        self.layouts = {}
+        
+        # Input shapes are padded up to registered buckets (or INPUT_LADDER) so
+        # cudnn.benchmark only ever tunes a handful of shapes
+        self.bucketing = bucketing
+        self.buckets = set()
+
+    
+    def bucket_for(self, h, w):
+        """Input shape an (h, w) image is padded to: the smallest fitting bucket, else the ladder."""
+        if not self.bucketing:
+            return h, w
+        fits = [(bh, bw) for bh, bw in self.buckets
+                if bh >= h and bw >= w and bh * bw <= MAX_BUCKET_PADDING * h * w]
+        if fits:
+            return min(fits, key=lambda shape: shape[0] * shape[1])
+        return ladder_size(h), ladder_size(w)
+    
+    def compile(self, mode="default"):
+        """Wrap the model in torch.compile; graphs are built lazily on the first forward of each shape."""
+        if not isinstance(self.model, nn.Module):
+            print("[Model] torch.compile needs an eager model, skipping")
+            return
+        self.model = torch.compile(self.eager_model, mode=mode, dynamic=False)
+    
+    def self_check(self, frame, scale=0.5, threshold=0.39, nms_kernel=21, max_peaks=4096, tolerance=0.03):
+        """Count a reference frame in fp32 eager and with the configured policy.
+        
+        If the counts differ by more than tolerance (relative, at least one
+        head) or the policy fails to run, fall back to fp32 eager. Returns True
+        when the configured policy was kept.
+        """
+        policy = (self.precision, self.model)
+        self.precision, self.model = "fp32", self.eager_model
+        reference, _ = self.run(frame, scale, threshold, nms_kernel, max_peaks)
+        self.precision, self.model = policy
+        
+        try:
+            count, _ = self.run(frame, scale, threshold, nms_kernel, max_peaks)
+        except Exception as e:
+            print(f"[Precision] {self.precision} failed ({e}), using fp32")
+        else:
+            if abs(count - reference) <= max(1.0, tolerance * reference):
+                print(f"[Precision] {self.precision} count {count} vs fp32 {reference}: ok")
+                return True
+            print(f"[Precision] {self.precision} count {count} vs fp32 {reference} is off by more than "
+                  f"{tolerance:.0%}, using fp32")
+        self.precision, self.model = "fp32", self.eager_model
+        return False
+    
+    def _tile_shapes(self, h, w):
+        layout = TileLayout(w, h, self.tile, self.tile_overlap)
+        counts = {min(self.tile_batch, len(layout)), len(layout) % self.tile_batch} - {0}
+        return {(count, layout.tile_h, layout.tile_w) for count in counts}
+    
+    def warmup(self, frame_sizes, scales, batch_sizes=(1,), runs=2, crop_sizes=()):
+        """Register the input shapes these frame sizes produce at these scales, then run
+        dummy forwards through them so cudnn.benchmark tunes at startup, not mid-stream.
+        
+        crop_sizes are (w, h) zone crops, registered as buckets of their own so
+        the startup zone runs unpadded. A zone dragged to a new size is padded
+        to a bucket or ladder step, which may not have been tuned yet.
+        """
+        shapes = set()
+        for (frame_w, frame_h), scale in itertools.product(frame_sizes, scales):
+            # Same rounding as GPUPreprocessor
+            h, w = int(frame_h * scale), int(frame_w * scale)
+            if self.tile:
+                shapes.update(self._tile_shapes(h, w))
+            else:
+                self.buckets.add((h, w))
+                shapes.update((count, h, w) for count in batch_sizes)
+        for (crop_w, crop_h), scale in itertools.product(crop_sizes, scales):
+            h, w = int(crop_h * scale), int(crop_w * scale)
+            if self.tile:
+                shapes.update(self._tile_shapes(h, w))
+            else:
+                self.buckets.add((h, w))
+                shapes.update((count, h, w) for count in batch_sizes)
+        if runs <= 0:
+            return
+        
+        start = time.perf_counter()
+        for count, h, w in sorted(shapes):
+            dummy = torch.zeros(count, 3, h, w, device=self.device)
+            if self.channels_last:
+                dummy = dummy.contiguous(memory_format=torch.channels_last)
+            for _ in range(runs):
+                self.forward(dummy)
+        if self.device == "cuda":
+            torch.cuda.synchronize()
+        print(f"[Warmup] {len(shapes)} input shapes in {time.perf_counter() - start:.1f}s")
+    
+    def preprocess(self, frame, scale=1.0):
+        image = self.preprocessor(frame, scale)
+        if self.channels_last:
+            image = image.contiguous(memory_format=torch.channels_last)
+        return image
+    
+    def forward(self, image):
+        """FIDT map for a preprocessed image, always returned as float32."""
+        dtype = PRECISION_DTYPES[self.precision]
+        with torch.inference_mode():
+            with torch.autocast(device_type=self.device, dtype=dtype, enabled=dtype is not None):
+                fidt = self.model(image)
+        return fidt.float()
+    
+    @contextlib.contextmanager
+    def timed(self, timings, stage):
+        """Record the enclosed device work as timings[stage], a DeviceSpan; no-op without timings."""
+        if timings is None:
+            yield
+            return
+        span = DeviceSpan(self.device)
+        yield
+        timings[stage] = span.stop()
+    
+    def forward_bucketed(self, image):
+        """FIDT map of an image padded up to its bucket, cropped back to the image.
+        
+        Padding keeps cudnn on tuned shapes but is not free: detections near the
+        padded edges may move slightly against an unpadded forward. Shapes
+        registered as buckets run unpadded.
+        """
+        h, w = image.shape[2:]
+        bucket_h, bucket_w = self.bucket_for(h, w)
+        if (bucket_h, bucket_w) != (h, w):
+            image = F.pad(image, (0, bucket_w - w, 0, bucket_h - h))
+        # NMS sees the unpadded region only. The network still sees the zero
+        # padding, so peaks near the right and bottom edges can shift a few pixels
+        return self.forward(image)[:, :, :h, :w]
+    
+    def detect(self, image, frame_w, frame_h, scale=0.5, threshold=0.39, nms_kernel=21, max_peaks=4096,
+               timings=None):
+        """Run HRNet + NMS on a preprocessed image and return (count, Detections) in frame space.
+        
+        With a timings dict, DeviceSpans of the forward and NMS are stored in it.
+        """
+        if self.tile:
+            # Tile forwards and NMS interleave, so the forward span covers both
+            with self.timed(timings, "forward"):
+                detections = self.detect_tiled(image, threshold, nms_kernel, max_peaks)
+            count = len(detections)
+        else:
+            with self.timed(timings, "forward"):
+                fidt = self.forward_bucketed(image)
+            with self.timed(timings, "nms"), torch.inference_mode():
+                count, detections = fast_nms_gpu(fidt, threshold, nms_kernel, max_peaks)
+        return count, detections.rescale(1.0 / scale, frame_w, frame_h)
+    
+    def detect_async(self, image, frame_w, frame_h, scale=0.5, threshold=0.39, nms_kernel=21, max_peaks=4096,
+                     timings=None):
+        """detect() without waiting for the device: returns a PendingResult.
+        
+        The forward and NMS are only queued; the compact peak buffer is copied
+        into pinned memory on the download stream, so the caller can move on to
+        the next frame while this one computes. Without streams (or when tiled)
+        this runs detect() and returns an already finished result.
+        """
+        if not self.streams or self.tile:
+            result = self.detect(image, frame_w, frame_h, scale, threshold, nms_kernel, max_peaks, timings)
+            return PendingResult(lambda: result)
+        
+        with self.timed(timings, "forward"):
+            fidt = self.forward_bucketed(image)
+        with torch.inference_mode():
+            with self.timed(timings, "nms"):
+                is_peak, flat, packed = nms_peaks_device(fidt, threshold, nms_kernel, max_peaks)
+            slot, done = self._queue_download(packed)
+        width = fidt.shape[-1]
+        
+        def finish():
+            with torch.inference_mode():
+                indices, scores = nms_peaks_host(slot["host"].numpy(), is_peak, flat)
+            # nms_peaks_host copied what it needs out of the buffer
+            slot["free"] = True
+            detections = peak_detections(indices, scores, width)
+            return len(detections), detections.rescale(1.0 / scale, frame_w, frame_h)
+        
+        return PendingResult(finish, done)
+    
+    def _queue_download(self, packed):
+        """Copy packed peaks to a pinned buffer on the download stream: (slot, done event).
+        
+        Without streams the copy is a plain blocking one and there is no event.
+        """
+        if not self.streams:
+            return {"host": packed.cpu(), "free": False}, None
+        self.download_stream.wait_stream(torch.cuda.current_stream())
+        slot = self._download_slot(packed.shape, packed.dtype)
+        with torch.cuda.stream(self.download_stream):
+            slot["host"].copy_(packed, non_blocking=True)
+            done = torch.cuda.Event()
+            done.record()
+        # packed was allocated on the compute stream but is read on the download stream
+        packed.record_stream(self.download_stream)
+        return slot, done
+    
+    def _download_slot(self, shape, dtype):
+        """Next pinned host buffer of this shape, reused once its last result was collected."""
+        key = (tuple(shape), dtype)
+        ring = self.downloads.get(key)
+        if ring is None:
+            ring = {"next": 0, "slots": [{"host": torch.empty(shape, dtype=dtype, pin_memory=True), "free": True}
+                                         for _ in range(self.download_slots)]}
+            self.downloads[key] = ring
+        slot = ring["slots"][ring["next"]]
+        if not slot["free"]:
+            # More results outstanding than slots - never overwrite one before it is read
+            return {"host": torch.empty(shape, dtype=dtype, pin_memory=True), "free": False}
+        ring["next"] = (ring["next"] + 1) % self.download_slots
+        slot["free"] = False
+        return slot
+    
+    def preprocess_scales(self, frame, scales, scale_timings=None):
+        """One preprocessed image of frame per scale.
+        
+        With a scale_timings dict, a preprocess DeviceSpan per scale is stored
+        in scale_timings[scale].
+        """
+        images = []
+        for scale in scales:
+            spans = scale_timings.setdefault(scale, {}) if scale_timings is not None else None
+            with self.timed(spans, "preprocess"):
+                images.append(self.preprocess(frame, scale))
+        return images
+    
+    def detect_multiscale(self, images, scales, frame_w, frame_h, threshold=0.39, nms_kernel=21, max_peaks=4096,
+                          radius=10, timings=None, scale_timings=None):
+        """Fused (count, Detections) in frame space over one image per scale, as a PendingResult.
+        
+        Each scale runs its own bucketed forward and device-side NMS, one after
+        another on the compute stream, so scale_timings[scale] gets a forward
+        and an nms DeviceSpan and operators can see what every extra scale
+        costs. The packed peaks of all scales are concatenated into a single
+        download, queued like detect_async's, so the frame still costs no host
+        sync. The frame-space peaks of all scales are then merged by a radius
+        dedupe that keeps the strongest. The scales' forwards and NMS
+        interleave, so the forward span in timings covers both.
+        """
+        per_scale = []
+        with self.timed(timings, "forward"):
+            for image, scale in zip(images, scales):
+                spans = scale_timings.setdefault(scale, {}) if scale_timings is not None else None
+                if self.tile:
+                    # Tile forwards and NMS interleave, so the forward span covers both
+                    with self.timed(spans, "forward"):
+                        per_scale.append(self.detect(image, frame_w, frame_h, scale, threshold, nms_kernel,
+                                                     max_peaks)[1])
+                    continue
+                with self.timed(spans, "forward"):
+                    fidt = self.forward_bucketed(image)
+                with self.timed(spans, "nms"), torch.inference_mode():
+                    per_scale.append((scale, fidt.shape[-1]) + nms_peaks_device(fidt, threshold, nms_kernel, max_peaks))
+        if self.tile:
+            result = self._fuse_scales(per_scale, radius)
+            return PendingResult(lambda: result)
+        
+        with torch.inference_mode():
+            slot, done = self._queue_download(torch.cat([packed for *_, packed in per_scale], dim=1))
+        ends = np.cumsum([packed.shape[1] for *_, packed in per_scale])
+        
+        def finish():
+            host = slot["host"].numpy()
+            fused = []
+            with torch.inference_mode():
+                for (scale, width, is_peak, flat, _), end, count in zip(per_scale, ends, np.diff(ends, prepend=0)):
+                    indices, scores = nms_peaks_host(host[:, end - count:end], is_peak, flat)
+                    fused.append(peak_detections(indices, scores, width).rescale(1.0 / scale, frame_w, frame_h))
+            # nms_peaks_host copied what it needs out of the buffer
+            slot["free"] = True
+            return self._fuse_scales(fused, radius)
+        
+        return PendingResult(finish, done)
+    
+    @staticmethod
+    def _fuse_scales(per_scale, radius):
+        fused = Detections(np.concatenate([d.points for d in per_scale]),
+                           np.concatenate([d.scores for d in per_scale])).dedupe(radius)
+        order = np.lexsort((fused.points[:, 0], fused.points[:, 1]))
+        return len(fused), fused.select(order)
+    
+    def detect_batch(self, images, sizes, scale=0.5, threshold=0.39, nms_kernel=21, max_peaks=4096,
+                     pad_multiple=1, timings=None):
+        """(count, Detections) per image for images from different frames.
+        
+        sizes holds each image's (frame_w, frame_h). One forward pass covers the
+        whole batch; each map is thresholded against its own max. Images of
+        different shapes are zero-padded (the normalized mean colour) bottom and
+        right to the largest shape rounded up to pad_multiple, and the padding is
+        masked out of the FIDT maps before NMS.
+        """
+        if self.tile or len(images) == 1:
+            # Tiling already batches inside a frame
+            return [self.detect(image, w, h, scale, threshold, nms_kernel, max_peaks, timings)
+                    for image, (w, h) in zip(images, sizes)]
+        
+        shapes = [tuple(image.shape[2:]) for image in images]
+        max_h, max_w = max(h for h, _ in shapes), max(w for _, w in shapes)
+        if self.bucketing:
+            batch_h, batch_w = self.bucket_for(max_h, max_w)
+        else:
+            batch_h, batch_w = bucket_shape(max_h, max_w, pad_multiple)
+        padded = any(shape != (batch_h, batch_w) for shape in shapes)
+        if padded:
+            images = [F.pad(image, (0, batch_w - w, 0, batch_h - h)) for image, (h, w) in zip(images, shapes)]
+        batch = torch.cat(images)
+        if self.channels_last:
+            batch = batch.contiguous(memory_format=torch.channels_last)
+        
+        with self.timed(timings, "forward"):
+            fidt = self.forward(batch)
+        with self.timed(timings, "nms"), torch.inference_mode():
+            if padded:
+                for i, (h, w) in enumerate(shapes):
+                    fidt[i, :, h:, :] = 0
+                    fidt[i, :, :, w:] = 0
+            per_image = fast_nms_batch(fidt, threshold, nms_kernel, max_peaks, joint_max=False)
+        return [(len(detections), detections.rescale(1.0 / scale, w, h))
+                for detections, (w, h) in zip(per_image, sizes)]
+    
+    def detect_tiled(self, image, threshold=0.39, nms_kernel=21, max_peaks=4096):
+        """Model-space Detections from overlapping tiles, tile_batch tiles per forward.
+        
+        Activation memory scales with tile size and tile_batch, not with the
+        source resolution.
+        """
+        h, w = image.shape[2:]
+        layout = self.layouts.get((w, h))
+        if layout is None:
+            layout = self.layouts[(w, h)] = TileLayout(w, h, self.tile, self.tile_overlap)
+        
+        tiles = layout.split(image)
+        if self.channels_last:
+            tiles = tiles.contiguous(memory_format=torch.channels_last)
+        fidt = torch.cat([self.forward(tiles[i:i + self.tile_batch])
+                          for i in range(0, len(layout), self.tile_batch)])
+        with torch.inference_mode():
+            per_tile = fast_nms_batch(fidt, threshold, nms_kernel, max_peaks)
+        return layout.merge(per_tile, nms_kernel // 2)
     
-    return count, kpoint
+    def run(self, frame, scale=0.5, threshold=0.39, nms_kernel=21, max_peaks=4096):
+        """Run HRNet + NMS on a BGR frame and return (count, Detections) in frame space."""
+        src_h, src_w = frame.shape[:2]
+        return self.detect(self.preprocess(frame, scale), src_w, src_h, scale, threshold, nms_kernel, max_peaks)
 
 
 # =============================================================================
@@ -1087,6 +2079,8 @@ class FrameGrabber:
         self.q = queue.Queue(maxsize=queue_size)
         self.stop_flag = threading.Event()
         self.thread = threading.Thread(target=self._worker, daemon=True)
+        # Frames overwritten before the consumer got to them
+        self.dropped = 0
 
     def start(self):
         self.thread.start()
@@ -1101,6 +2095,7 @@ class FrameGrabber:
             if self.q.full():
                 try:
                     self.q.get_nowait()
+                    self.dropped += 1
                 except: 
                     pass
             try:
@@ -1122,13 +2117,12 @@ class FrameGrabber:
 # VISUALIZATION
 # =============================================================================
 
-def draw_boxes(frame, kpoint, box_size=14, thickness=2, color=(0, 255, 0)):
-    ys, xs = np.nonzero(kpoint)
-    if len(xs) == 0:
+def draw_boxes(frame, points, box_size=14, thickness=2, color=(0, 255, 0)):
+    if len(points) == 0:
         return
     h, w = frame.shape[:2]
     half = box_size // 2
-    for y, x in zip(ys, xs):
+    for x, y in points.tolist():
         cv2.rectangle(frame, (max(0, x - half), max(0, y - half)),
                      (min(w - 1, x + half), min(h - 1, y + half)), color, thickness)
 
@@ -1165,11 +2159,10 @@ def draw_info_panel(frame, info_dict, x=30, y=40):
         current_y += line_height
         
 
-def draw_dots(frame, kpoint, radius=1, color=(0, 0, 255)):
-    ys, xs = np.nonzero(kpoint)
-    if len(xs) == 0:
+def draw_dots(frame, points, radius=1, color=(0, 0, 255)):
+    if len(points) == 0:
         return
-    for y, x in zip(ys, xs):
+    for x, y in points.tolist():
         # Use AA for smooth dots
         cv2.circle(frame, (x, y), radius, color, -1, lineType=cv2.LINE_AA)
 
@@ -1204,7 +2197,10 @@ def start_control_thread():
             except Exception:
                 continue
             if message.get("type") == "config":
-                control_q.put(message.get("config", {}))
+                config = dict(message.get("config", {}))
+                if "feed" in message:
+                    config["feed"] = message["feed"]
+                control_q.put(config)
 
     threading.Thread(target=_reader, daemon=True).start()
     return control_q
@@ -1226,24 +2222,43 @@ def apply_zone_rect(zone, zone_rect_norm, frame_w, frame_h):
     zone._normalize_rect()
 
 
-def filter_points_to_tracking_rect(points, zone_rect, frame_w, frame_h, margin_ratio=0.18):
-    if points is None or len(points) == 0 or not zone_rect:
-        return points
-
+def tracking_rect(zone_rect, frame_w, frame_h, margin_ratio=0.18):
+    """Zone rect grown by the tracking margin (at least 30 px a side), clipped to the frame."""
     x1, y1, x2, y2 = zone_rect
     margin_x = max(30, int((x2 - x1) * margin_ratio))
     margin_y = max(30, int((y2 - y1) * margin_ratio))
-    rx1 = max(0, x1 - margin_x)
-    ry1 = max(0, y1 - margin_y)
-    rx2 = min(frame_w, x2 + margin_x)
-    ry2 = min(frame_h, y2 + margin_y)
+    return max(0, x1 - margin_x), max(0, y1 - margin_y), min(frame_w, x2 + margin_x), min(frame_h, y2 + margin_y)
+
+
+def inference_roi(zone_rect, frame_w, frame_h, sweep=False, pad=32, align=32):
+    """Frame region HRNet has to see for a zone, or None if it is degenerate.
+    
+    That is the zone (or its tracking rect in sweep mode) plus pad pixels of
+    context, snapped outward to an align grid so small drags reuse input shapes.
+    """
+    x1, y1, x2, y2 = tracking_rect(zone_rect, frame_w, frame_h) if sweep else zone_rect
+    x1 = max(0, (int(x1) - pad) // align * align)
+    y1 = max(0, (int(y1) - pad) // align * align)
+    x2 = min(frame_w, -(-(int(x2) + pad) // align) * align)
+    y2 = min(frame_h, -(-(int(y2) + pad) // align) * align)
+    if x2 - x1 < align or y2 - y1 < align:
+        return None
+    return x1, y1, x2, y2
+
+
+def filter_points_to_tracking_rect(detections, zone_rect, frame_w, frame_h, margin_ratio=0.18):
+    if detections is None or len(detections) == 0 or not zone_rect:
+        return detections
+
+    rx1, ry1, rx2, ry2 = tracking_rect(zone_rect, frame_w, frame_h, margin_ratio)
+    points = detections.points
     mask = (
         (points[:, 0] >= rx1)
         & (points[:, 0] <= rx2)
         & (points[:, 1] >= ry1)
         & (points[:, 1] <= ry2)
     )
-    return points[mask]
+    return detections.select(mask)
 
 
 def apply_control_messages(control_q, zone, frame_w, frame_h, default_margin, show_overlay, tracker=None):
@@ -1293,11 +2308,15 @@ def apply_control_messages(control_q, zone, frame_w, frame_h, default_margin, sh
 # STREAM RECONNECTION
 # =============================================================================
 
-def reconnect_stream(source, max_retries=5, initial_delay=1.0):
-    """Attempt to reconnect to a stream with exponential backoff."""
+def reconnect_stream(source, max_retries=5, initial_delay=1.0, stop_flag=None):
+    """Attempt to reconnect to a stream with exponential backoff; gives up early once stop_flag is set."""
+    if stop_flag is None:
+        stop_flag = threading.Event()
     is_stream = source.lower().startswith(("rtsp://", "rtmp://", "http://"))
     
     for attempt in range(max_retries):
+        if stop_flag.is_set():
+            break
         try:
             print(f"[Reconnect] Attempt {attempt + 1}/{max_retries}...")
             cap = cv2.VideoCapture(source, cv2.CAP_FFMPEG) if is_stream else cv2.VideoCapture(source)
@@ -1312,52 +2331,1437 @@ def reconnect_stream(source, max_retries=5, initial_delay=1.0):
             if attempt < max_retries - 1:
                 delay = initial_delay * (2 ** attempt)
                 print(f"[Reconnect] Failed, retrying in {delay:.1f}s...")
-                time.sleep(delay)
+                stop_flag.wait(delay)
         except Exception as e:
             print(f"[Reconnect] Error: {e}")
             if attempt < max_retries - 1:
-                time.sleep(initial_delay * (2 ** attempt))
+                stop_flag.wait(initial_delay * (2 ** attempt))
     
     return None, None
 
 
 # =============================================================================
-# MAIN
+# MOTION PROPAGATION
 # =============================================================================
 
-def main():
-    parser = argparse.ArgumentParser(description='Crowd Counter with Draggable Zone')
+def propagate_points_flow(prev_gray, gray, points, win_size=21):
+    """Move points from prev_gray to gray with pyramidal Lucas-Kanade flow.
     
-    parser.add_argument('--source', '-s', required=True, help='Video source')
-    parser.add_argument('--output', '-o', default='', help='Stream output URL')
-    parser.add_argument('--save', default='', help='Save to file')
-    parser.add_argument('--model', '-m', default='', help='Model path')
-    parser.add_argument('--preset', '-p', default='accurate', choices=list(PRESETS.keys()))
-    parser.add_argument('--show', action='store_true', help='Show preview')
-    parser.add_argument('--json', action='store_true', help='JSON output')
+    Points the flow loses keep their previous position.
+    """
+    if len(points) == 0:
+        return points
+    p0 = np.asarray(points, dtype=np.float32).reshape(-1, 1, 2)
+    p1, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray, p0, None,
+                                             winSize=(win_size, win_size), maxLevel=2)
+    moved = p0.reshape(-1, 2).copy()
+    found = status.reshape(-1) == 1
+    moved[found] = p1.reshape(-1, 2)[found]
+    return moved
+
+
+# =============================================================================
+# ADAPTIVE CONTROL
+# =============================================================================
+
+# Density tiers of the adaptive controller, sparsest first: (preset, heads where the next tier starts)
+ADAPTIVE_TIERS = [
+    ("sparse", 50),
+    ("accurate", 500),
+    ("dense", 1000),
+    ("ultra_dense", None),
+]
+
+
+class PresetController:
+    """Switch scale / threshold / nms_kernel between PRESETS tiers at runtime.
     
-    parser.add_argument('--sweep', action='store_true', help='Enable sweep mode')
-    parser.add_argument('--max_dist', type=int, default=50)
-    parser.add_argument('--memory', type=int, default=60)
-    parser.add_argument('--min_hits', type=int, default=3)
+    Density picks the tier: a smoothed count has to leave the tier's band by
+    the hysteresis margin, and at least `dwell` inferences must pass between
+    switches. Stepping down to a sparser tier is vetoed while its threshold
+    and wider NMS window would drop more than max_drop of the current peaks.
     
-    parser.add_argument('--zone', action='store_true', help='Enable draggable zone')
-    parser.add_argument('--zone_margin', type=int, default=80)
-    parser.add_argument('--zone_overlay', action='store_true')
-    parser.add_argument('--zone_rect_norm', type=str, default='', help='Normalized zone x1,y1,x2,y2 from UI')
-    parser.add_argument('--hide_zone', action='store_true', help='Use zone for filtering without drawing it')
-    parser.add_argument('--hide_hud', action='store_true', help='Do not draw count/FPS/help text on frames')
+    Latency caps the scale: while the inference rate (frames per second the
+    preprocess + forward + NMS time allows, times the skip) is below min_fps,
+    the scale steps down through the preset scales; it steps back up once the
+    rate clears min_fps by the hysteresis margin.
+    """
+    
+    def __init__(self, preset="accurate", min_fps=15.0, hysteresis=0.15, dwell=10, max_drop=0.1, alpha=0.2):
+        names = [name for name, _ in ADAPTIVE_TIERS]
+        self.tier = names.index(preset) if preset in names else names.index("accurate")
+        self.min_fps = min_fps
+        self.hysteresis = hysteresis
+        self.dwell = dwell
+        self.max_drop = max_drop
+        self.alpha = alpha
+        self.scale_steps = sorted({p["scale"] for p in PRESETS.values()}, reverse=True)
+        self.scale_cap = None
+        self.count = None
+        self.infer_ms = None
+        self.since_switch = 0
+    
+    @property
+    def preset(self):
+        return ADAPTIVE_TIERS[self.tier][0]
+    
+    def settings(self):
+        """(scale, threshold, nms_kernel) to run with now."""
+        preset = PRESETS[self.preset]
+        scale = preset["scale"]
+        if self.scale_cap is not None:
+            scale = min(scale, self.scale_cap)
+        return scale, preset["threshold"], preset["nms_kernel"]
+    
+    def scales(self):
+        """Every scale the controller can pick, for warm-up."""
+        return sorted(self.scale_steps)
+    
+    def update(self, detections, infer_ms, skip=1):
+        """Feed one inferred frame. Returns True when settings() changed."""
+        count = len(detections)
+        self.count = count if self.count is None else (1 - self.alpha) * self.count + self.alpha * count
+        if infer_ms:
+            self.infer_ms = infer_ms if self.infer_ms is None else (1 - self.alpha) * self.infer_ms + self.alpha * infer_ms
+        self.since_switch += 1
+        if self.since_switch < self.dwell:
+            return False
+        
+        before = self.settings()
+        self._update_tier(detections)
+        if self.infer_ms:
+            self._update_scale_cap(1000.0 * skip / self.infer_ms)
+        if self.settings() == before:
+            return False
+        self.since_switch = 0
+        return True
+    
+    def _update_tier(self, detections):
+        upper = ADAPTIVE_TIERS[self.tier][1]
+        lower = ADAPTIVE_TIERS[self.tier - 1][1] if self.tier > 0 else None
+        if upper is not None and self.count > upper * (1 + self.hysteresis):
+            self.tier += 1
+        elif lower is not None and self.count < lower * (1 - self.hysteresis) and not self._drops_peaks(detections):
+            self.tier -= 1
+    
+    def _drops_peaks(self, detections):
+        """Whether the next sparser tier would discard more than max_drop of these peaks.
+        
+        Its threshold is not always higher (sparse sits below accurate), but its
+        NMS window is always wider, so both are replayed on the current peaks.
+        """
+        if len(detections) == 0:
+            return False
+        sparser = PRESETS[ADAPTIVE_TIERS[self.tier - 1][0]]
+        # The strongest peak is the FIDT max the NMS threshold is relative to
+        relative = detections.scores / detections.scores.max()
+        kept = detections.select(relative >= sparser["threshold"])
+        # The NMS window in frame space, as for the multi-scale fusion radius
+        kept = kept.dedupe(max(1, round((sparser["nms_kernel"] // 2) / sparser["scale"])))
+        return 1 - len(kept) / len(detections) > self.max_drop
+    
+    def _update_scale_cap(self, infer_fps):
+        scale = self.settings()[0]
+        if infer_fps < self.min_fps:
+            smaller = [s for s in self.scale_steps if s < scale]
+            if smaller:
+                self.scale_cap = smaller[0]
+        elif self.scale_cap is not None and infer_fps > self.min_fps * (1 + self.hysteresis):
+            larger = [s for s in self.scale_steps if s > self.scale_cap]
+            self.scale_cap = larger[-1] if larger and larger[-1] < PRESETS[self.preset]["scale"] else None
+
+
+def budget_scales(frame_w, frame_h, min_scale, max_scale):
+    """Scales that put the long side of the input exactly on an INPUT_LADDER step.
+    
+    These are the steps in [min_scale, max_scale]; when the range is narrower
+    than a ladder step, the single step nearest to it. The long side then never
+    pads and the budget only moves between shapes that warm-up has tuned.
+    """
+    long_side = max(frame_w, frame_h)
+    steps = [size / long_side for size in INPUT_LADDER]
+    scales = [s for s in steps if min_scale <= s <= max_scale]
+    if not scales:
+        scales = [min(steps, key=lambda s: max(min_scale - s, s - max_scale))]
+    return scales
+
+
+class LatencyBudget:
+    """Hold target_fps by moving the scale along budget_scales, then the skip interval.
+    
+    Each inference may take skip frame budgets times headroom (the rest is left
+    for capture, tracking and drawing). Over budget, the scale steps down, and
+    once it is at the bottom the skip interval grows up to max_skip. Under
+    budget by the hysteresis margin, the skip comes back down first, then the
+    scale goes up; a step up is only taken when the cost predicted from the
+    input area still fits. Measurements restart after every change, and the
+    generation is bumped so samples from frames still in flight at the old
+    settings can be told apart and ignored.
+    """
+    
+    def __init__(self, target_fps, scales, scale, skip=1, max_skip=4, headroom=0.8, hysteresis=0.15, dwell=5,
+                 alpha=0.3):
+        self.budget_ms = 1000.0 / target_fps
+        self.scales = scales
+        self.index = min(range(len(scales)), key=lambda i: abs(scales[i] - scale))
+        self.min_skip = skip
+        self.skip = skip
+        self.max_skip = max(skip, max_skip)
+        self.headroom = headroom
+        self.hysteresis = hysteresis
+        self.dwell = dwell
+        self.alpha = alpha
+        self.infer_ms = None
+        self.samples = 0
+        self.generation = 0
+    
+    @property
+    def scale(self):
+        return self.scales[self.index]
+    
+    def _allowed_ms(self, skip):
+        return skip * self.budget_ms * self.headroom
+    
+    def update(self, infer_ms, generation=None):
+        """Feed one inference's busy time, measured on a frame built under generation.
+        Returns True when scale or skip changed."""
+        if not infer_ms or (generation is not None and generation != self.generation):
+            return False
+        self.infer_ms = infer_ms if self.infer_ms is None else (1 - self.alpha) * self.infer_ms + self.alpha * infer_ms
+        self.samples += 1
+        if self.samples < self.dwell:
+            return False
+        
+        before = (self.index, self.skip)
+        slack = 1 - self.hysteresis
+        if self.infer_ms > self._allowed_ms(self.skip):
+            if self.index > 0:
+                self.index -= 1
+            elif self.skip < self.max_skip:
+                self.skip += 1
+        elif self.skip > self.min_skip:
+            if self.infer_ms < self._allowed_ms(self.skip - 1) * slack:
+                self.skip -= 1
+        elif self.index + 1 < len(self.scales):
+            # Cost grows with the input area
+            predicted = self.infer_ms * (self.scales[self.index + 1] / self.scale) ** 2
+            if predicted < self._allowed_ms(self.skip) * slack:
+                self.index += 1
+        
+        if (self.index, self.skip) == before:
+            return False
+        self.infer_ms, self.samples = None, 0
+        self.generation += 1
+        return True
+
+
+# =============================================================================
+# PERF STATS
+# =============================================================================
+
+# Stages reported in the perf message, in frame order
+PERF_STAGES = ("capture", "preprocess", "forward", "nms", "track", "draw", "write")
+
+
+class DeviceSpan:
+    """Duration of a span of device work.
+    
+    On CUDA it is a pair of timing events on the current stream, so reading it
+    once the work has finished costs no extra sync; elsewhere the wall clock.
+    """
+    
+    def __init__(self, device):
+        self.events = None
+        if device == "cuda":
+            self.events = (torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True))
+            self.events[0].record()
+        else:
+            self.start = time.perf_counter()
+    
+    def stop(self):
+        if self.events:
+            self.events[1].record()
+        else:
+            self.end = time.perf_counter()
+        return self
+    
+    def ms(self):
+        if self.events:
+            self.events[1].synchronize()
+            return self.events[0].elapsed_time(self.events[1])
+        return (self.end - self.start) * 1000
+
+
+def add_stage_spans(jobs, timings):
+    """Resolve an engine timings dict of DeviceSpans into each job's stage_ms."""
+    stage_ms = {stage: span.ms() for stage, span in timings.items()}
+    for job in jobs:
+        job["stage_ms"].update(stage_ms)
+
+
+class PerfStats:
+    """Rolling window of per-stage latencies (ms) with percentile summaries."""
+    
+    def __init__(self, window=300):
+        self.samples = {stage: collections.deque(maxlen=window) for stage in PERF_STAGES}
+    
+    def add(self, stage, ms):
+        self.samples[stage].append(ms)
+    
+    def summary(self):
+        """{stage: {p50, p95, p99}} for every stage with samples."""
+        summary = {}
+        for stage, samples in self.samples.items():
+            # list() copies in one step, so appends from stage threads are safe
+            values = list(samples)
+            if values:
+                p50, p95, p99 = np.percentile(values, (50, 95, 99))
+                summary[stage] = {"p50": round(float(p50), 2), "p95": round(float(p95), 2),
+                                  "p99": round(float(p99), 2)}
+        return summary
+
+
+# =============================================================================
+# FEED SESSION
+# =============================================================================
+
+def multiscale_scales(text, scale):
+    """Absolute inference scales from comma-separated multiples of the base scale."""
+    factors = sorted({float(f) for f in text.split(',') if f.strip()})
+    if not factors or min(factors) <= 0:
+        raise ValueError(f"Invalid --ms_scales '{text}'")
+    return [scale * f for f in factors]
+
+
+class FeedSession:
+    """Capture, zone, tracker, outputs and latest results for one video source."""
+    
+    def __init__(self, args, source, scale, threshold, nms_kernel, feed=None):
+        self.args = args
+        self.source = source
+        self.feed = feed
+        
+        # Inference settings, replaced whole by set_params. Multi-scale mode adds
+        # the absolute scales, a peak threshold, and the frame-space radius that
+        # fuses one head seen at several scales
+        self.ms_threshold = args.ms_threshold or threshold
+        # Rolling ms per scale of its preprocess, forward and NMS
+        self.scale_ms = {}
+        
+        # Adaptive mode: the controller owns scale / threshold / nms_kernel, except
+        # that with a latency budget (set up once the resolution is known) the
+        # budget owns scale and skip
+        self.budget = None
+        self.set_params(scale, threshold, nms_kernel, args.skip)
+        min_fps = 0.0 if args.target_fps > 0 else args.adaptive_min_fps
+        self.controller = PresetController(args.preset, min_fps) if args.adaptive else None
+        if self.controller:
+            self.set_params(*self.controller.settings())
+        self.is_stream = source.lower().startswith(("rtsp://", "rtmp://", "http://"))
+        
+        self.cap = None
+        self.grabber = None
+        self.zone = None
+        self.tracker = None
+        self.streamer = None
+        self.writer = None
+        self.show_overlay = args.zone_overlay
+        
+        # Tracker and zone changes from the UI thread, run by whichever thread tracks
+        self.commands = queue.Queue()
+        # Set on shutdown; a capture thread stops reading (and reconnecting) once it is
+        self.stop_flag = threading.Event()
+        
+        self.frame_num = 0
+        self.consecutive_failures = 0
+        self.max_consecutive_failures = 10
+        self.fps, self.fps_start, self.fps_count = 0, time.time(), 0
+        self.last_count, self.last_detections = 0, Detections()
+        self.last_viewport, self.last_total, self.last_positions = 0, 0, np.array([])
+        self.last_stats_time = 0
+        
+        # Per-stage latencies, watched queues and lost frames for the perf message
+        self.perf = PerfStats()
+        self.perf_queues = {}
+        self.last_perf_time = time.time()
+        self.dropped_frames = 0
+        self.read_failures = 0
+        
+        # Skipped-frame propagation state
+        self.propagate = args.propagate
+        if self.propagate == 'velocity' and not args.sweep:
+            print("[Skip] Velocity propagation needs --sweep, using optical flow")
+            self.propagate = 'flow'
+        self.frames_since_inference = 0
+        self.prev_gray = None
+        self.flow_points = None
+    
+    def open(self):
+        """Open the source and set up zone, outputs and tracker. Returns False on failure."""
+        args = self.args
+        print(f"[Source]{self.label} Opening: {self.source}")
+        self.cap = self._open_capture()
+        
+        if not self.cap.isOpened():
+            print("[ERROR] Cannot open source")
+            return False
+        
+        ret, frame = self.cap.read()
+        if not ret:
+            print("[ERROR] Cannot read from source")
+            return False
+        
+        self.src_h, self.src_w = frame.shape[:2]
+        # Reference frame for the startup precision check
+        self.probe_frame = frame
+        print(f"[Source]{self.label} Resolution:  {self.src_w}x{self.src_h}")
+        
+        if args.target_fps > 0:
+            scales = budget_scales(self.src_w, self.src_h, args.min_scale, args.max_scale)
+            self.budget = LatencyBudget(args.target_fps, scales, self.scale, args.skip, args.max_skip)
+            self.set_params(self.budget.scale, self.threshold, self.nms_kernel)
+            print(f"[Budget]{self.label} {args.target_fps:g} FPS from scale {self.scale:.3f}, "
+                  f"steps {', '.join(f'{s:.3f}' for s in scales)}")
+        
+        self.out_w, self.out_h = self.src_w, self.src_h
+        if args.stream_width > 0 and args.stream_height > 0:
+            self.out_w, self.out_h = args.stream_width, args.stream_height
+        elif args.stream_width > 0:
+            self.out_w = args.stream_width
+            self.out_h = max(1, int(self.src_h * (self.out_w / self.src_w)))
+        elif args.stream_height > 0:
+            self.out_h = args.stream_height
+            self.out_w = max(1, int(self.src_w * (self.out_h / self.src_h)))
+        
+        # Setup zone
+        self.zone = DraggableZone(self.src_w, self.src_h, margin=args.zone_margin) if args.zone else None
+        if self.zone and args.zone_rect_norm:
+            try:
+                apply_zone_rect(self.zone, args.zone_rect_norm, self.src_w, self.src_h)
+            except Exception as e:
+                print(f"[Zone] Invalid zone_rect_norm '{args.zone_rect_norm}': {e}")
+        
+        # Setup streamer
+        self.streamer = self._create_streamer() if args.output else None
+        
+        # Setup writer
+        self.writer = cv2.VideoWriter(args.save, cv2.VideoWriter_fourcc(*'mp4v'), 24, (self.src_w, self.src_h)) if args.save else None
+        
+        # Setup grabber
+        if self.source.lower().startswith(("rtsp://", "rtmp://")):
+            self.cap.release()
+            self.cap = cv2.VideoCapture(self.source, cv2.CAP_FFMPEG)
+            self.grabber = FrameGrabber(self.cap, queue_size=max(1, args.queue_size)).start()
+        
+        # Setup tracker
+        if args.sweep:
+            self.tracker = ImprovedSweepTracker(
+                max_distance=args.max_dist,
+                max_age=10,
+                max_lost_age=args.memory,
+                min_hits=args.min_hits,
+                association=args.assoc,
+            )
+        return True
+    
+    def set_params(self, scale, threshold, nms_kernel, skip=None):
+        """Change inference settings mid-stream; skip=None keeps the current skip.
+        
+        They are published as one new params dict, which next_job copies into
+        each job, so the capture thread never sees half an update and jobs
+        already in flight keep the settings they were read with. Each job also
+        carries the latency budget generation these settings belong to.
+        """
+        self.params = {
+            "scale": scale,
+            "threshold": threshold,
+            "nms_kernel": nms_kernel,
+            "scales": multiscale_scales(self.args.ms_scales, scale) if self.args.multiscale else None,
+            "ms_radius": self.args.ms_nms_radius or max(1, round((nms_kernel // 2) / scale)),
+            "skip": skip or self.skip,
+            "budget_generation": self.budget.generation if self.budget else None,
+        }
+    
+    @property
+    def scale(self):
+        return self.params["scale"]
+    
+    @property
+    def threshold(self):
+        return self.params["threshold"]
+    
+    @property
+    def nms_kernel(self):
+        return self.params["nms_kernel"]
+    
+    @property
+    def scales(self):
+        return self.params["scales"]
+    
+    @property
+    def skip(self):
+        return self.params["skip"]
+    
+    
+    @property
+    def label(self):
+        """Log prefix suffix naming the feed in multi-feed mode."""
+        return f"[{self.feed}]" if self.feed is not None else ""
+    
+    def _open_capture(self):
+        if self.source.lower().startswith(("rtsp://", "rtmp://")):
+            return cv2.VideoCapture(self.source, cv2.CAP_FFMPEG)
+        return cv2.VideoCapture(self.source)
+    
+    def _create_streamer(self):
+        args = self.args
+        return create_streamer(
+            args.output,
+            self.out_w,
+            self.out_h,
+            fps=args.stream_fps,
+            bitrate=args.stream_bitrate,
+            codec=args.stream_codec,
+            preset=args.stream_preset,
+            use_nvenc=args.nvenc,
+        )
+    
+    def read(self):
+        """Return the next frame at session resolution, or None once the source has ended or stop_flag is set."""
+        while not self.stop_flag.is_set():
+            # Fix: Don't call cap.read() twice - it skips frames!
+            if self.grabber:
+                frame = self.grabber.read(timeout=2.0)
+            else:
+                ret, frame = self.cap.read()
+                if not ret:
+                    frame = None
+            
+            if frame is None:
+                self.consecutive_failures += 1
+                self.read_failures += 1
+                
+                # Try to reconnect for streams
+                if self.is_stream and self.consecutive_failures < self.max_consecutive_failures:
+                    print(f"[Warning] Frame read failed ({self.consecutive_failures}/{self.max_consecutive_failures})")
+                    
+                    # Attempt reconnection
+                    if self.grabber:
+                        self.grabber.stop()
+                        self.dropped_frames += self.grabber.dropped
+                    self.cap.release()
+                    
+                    new_cap, new_frame = reconnect_stream(self.source, stop_flag=self.stop_flag)
+                    if new_cap is not None and new_frame is not None:
+                        self.cap = new_cap
+                        if self.grabber:
+                            self.grabber = FrameGrabber(self.cap, queue_size=max(1, self.args.queue_size)).start()
+                        frame = new_frame
+                        self.consecutive_failures = 0
+                        print("[Info] Reconnected successfully, resuming...")
+                    else:
+                        print("[Error] Reconnection failed")
+                        self.stop_flag.wait(1.0)
+                        continue
+                else:
+                    print("[INFO] Stream ended or too many failures")
+                    return None
+            else:
+                self.consecutive_failures = 0
+            
+            if frame.shape[: 2] != (self.src_h, self.src_w):
+                frame = cv2.resize(frame, (self.src_w, self.src_h))
+            return frame
+        return None
+    
+    def next_job(self):
+        """Read a frame and wrap it as a pipeline job, or None once the source has ended."""
+        start = time.perf_counter()
+        frame = self.read()
+        if frame is None:
+            return None
+        self.frame_num += 1
+        params = self.params
+        job = {
+            "frame_num": self.frame_num,
+            "frame": frame,
+            "infer": self.frame_num % params["skip"] == 0,
+            # scale, threshold, nms_kernel, scales, ms_radius, skip, budget_generation
+            **params,
+            "roi": None,
+            "feed": self.feed,
+            "stage_ms": {"capture": (time.perf_counter() - start) * 1000},
+        }
+        if job["infer"]:
+            # Snapshot now - the zone can be dragged while the job is in flight
+            job["roi"] = self.zone_roi()
+        return job
+    
+    def zone_roi(self):
+        """Frame region --zone_infer crops inference to for the current zone, or None for the whole frame."""
+        zone = self.zone
+        if not (self.args.zone_infer and zone and zone.enabled):
+            return None
+        return inference_roi(zone.get_rect(), self.src_w, self.src_h, self.args.sweep, self.args.zone_infer_pad)
+    
+    def track(self, job):
+        """Apply zone filtering and tracking to a job's detections and attach the results."""
+        self._run_commands()
+        for scale, stages in job.get("scale_ms", {}).items():
+            self._record_scale(scale, stages)
+        if job["infer"] and self.budget:
+            self._hold_budget(job)
+        if job["infer"] and self.controller:
+            self._adapt(job)
+        if job["infer"]:
+            start = time.perf_counter()
+            try:
+                self._track_detections(job["count"], job["detections"], job["frame"].shape)
+            except Exception as e:
+                print(f"[Error] Tracking failed: {e}")
+            job["stage_ms"]["track"] = (time.perf_counter() - start) * 1000
+        for stage, ms in job["stage_ms"].items():
+            self.perf.add(stage, ms)
+        
+        job["count"], job["detections"] = self.last_count, self.last_detections
+        job["viewport"], job["total"], job["positions"] = self.last_viewport, self.last_total, self.last_positions
+        if self.propagate != 'off':
+            self._propagate(job)
+        return job
+    
+    def _record_scale(self, scale, stages):
+        """Fold one frame's per-stage ms at one scale into the rolling scale_ms."""
+        rolling = self.scale_ms.setdefault(scale, {})
+        for stage, ms in stages.items():
+            rolling[stage] = ms if stage not in rolling else 0.9 * rolling[stage] + 0.1 * ms
+    
+    def _hold_budget(self, job):
+        if self.budget.update(job.get("infer_ms"), job["budget_generation"]):
+            print(f"[Budget]{self.label} scale {self.budget.scale:.3f}, skip {self.budget.skip}")
+            self.set_params(self.budget.scale, self.threshold, self.nms_kernel, self.budget.skip)
+    
+    def _adapt(self, job):
+        if self.controller.update(job["detections"], job.get("infer_ms"), self.skip):
+            scale, threshold, nms_kernel = self.controller.settings()
+            if self.budget:
+                scale = self.scale
+            print(f"[Adaptive]{self.label} {self.controller.preset}: scale {scale}, threshold {threshold}, "
+                  f"nms {nms_kernel} (count ~{self.controller.count:.0f}, {self.controller.infer_ms:.0f} ms/inference)")
+            self.set_params(scale, threshold, nms_kernel)
+    
+    def _propagate(self, job):
+        """Carry the last results forward on frames that skipped inference."""
+        if job["infer"]:
+            self.frames_since_inference = 0
+        else:
+            self.frames_since_inference += 1
+        
+        if self.propagate == 'velocity':
+            if self.frames_since_inference > 0:
+                # The tracker updates once every skip frames
+                job["positions"] = self.tracker.extrapolate(self.frames_since_inference / job["skip"])
+            return
+        
+        gray = cv2.cvtColor(job["frame"], cv2.COLOR_BGR2GRAY)
+        if job["infer"] or self.prev_gray is None:
+            self.flow_points = job["positions"] if self.args.sweep else job["detections"].points
+        else:
+            self.flow_points = propagate_points_flow(self.prev_gray, gray, self.flow_points)
+            if self.args.sweep:
+                job["positions"] = self.flow_points
+            else:
+                points = np.rint(self.flow_points).astype(np.int64)
+                points[:, 0] = np.clip(points[:, 0], 0, self.src_w - 1)
+                points[:, 1] = np.clip(points[:, 1], 0, self.src_h - 1)
+                job["detections"] = Detections(points, self.last_detections.scores)
+        self.prev_gray = gray
+    
+    def _track_detections(self, count, detections, frame_shape):
+        self.last_count, self.last_detections = count, detections
+        
+        zone = self.zone
+        zone_rect = zone.get_rect() if zone and zone.enabled else None
+        if zone and zone.enabled and not self.args.sweep:
+            self.last_detections = zone.filter_points(self.last_detections)
+            self.last_count = len(self.last_detections)
+        
+        if self.tracker:
+            detections = self.last_detections
+            if zone_rect is not None:
+                detections = filter_points_to_tracking_rect(detections, zone_rect, self.src_w, self.src_h)
+            self.last_viewport, self.last_total, self.last_positions = self.tracker.update(
+                detections.points, frame_shape, zone_rect
+            )
+    
+    def render(self, job):
+        """Draw overlays and HUD for a tracked job onto its frame."""
+        args = self.args
+        frame = job["frame"]
+        zone = self.zone
+        
+        self.fps_count += 1
+        if time.time() - self.fps_start >= 1.0:
+            self.fps = self.fps_count / (time.time() - self.fps_start)
+            self.fps_count, self.fps_start = 0, time.time()
+        start = time.perf_counter()
+        
+        if zone and self.show_overlay and not args.hide_zone:
+            zone.draw_overlay(frame, alpha=0.3)
+        
+        if args.dot:
+            if args.sweep:
+                draw_tracked_dots(frame, job["positions"], radius=max(1, args.box_size // 2))
+            else:
+                draw_dots(frame, job["detections"].points, radius=max(1, args.box_size // 2))
+        else:
+            if args.sweep:
+                draw_tracked_points(frame, job["positions"], args.box_size, args.box_thickness)
+            else:
+                draw_boxes(frame, job["detections"].points, args.box_size, args.box_thickness)
+        
+        if zone and zone.visible and not args.hide_zone:
+            zone.draw(frame)
+        
+        info = {"title": "SWEEP MODE" if args.sweep else "COUNT",
+                "total": job["total"] if args.sweep else job["count"],
+                "viewport": job["viewport"]} if args.sweep else {"title":  "COUNT", "total": job["count"]}
+        info["fps"] = self.fps
+        
+        if not args.hide_hud:
+            draw_info_panel(frame, info)
+            draw_help(frame)
+        self.perf.add("draw", (time.perf_counter() - start) * 1000)
+        return frame
+    
+    def write(self, frame):
+        """Send a rendered frame to the stream output and the recording."""
+        start = time.perf_counter()
+        if self.streamer:
+            try:
+                stream_frame = frame
+                if (self.out_w, self.out_h) != (self.src_w, self.src_h):
+                    stream_frame = cv2.resize(frame, (self.out_w, self.out_h))
+                self.streamer.stdin.write(stream_frame.tobytes())
+            except Exception as e:
+                print(f"[Error] Streamer write failed: {e}, attempting to recreate...")
+                try:
+                    self.streamer.stdin.close()
+                    self.streamer.wait()
+                except:
+                    pass
+                self.streamer = self._create_streamer()
+        
+        if self.writer:
+            self.writer.write(frame)
+        if self.streamer or self.writer:
+            self.perf.add("write", (time.perf_counter() - start) * 1000)
+    
+    def submit(self, command):
+        """Run command() on the thread that tracks, between two frames."""
+        self.commands.put(command)
+    
+    def _run_commands(self):
+        while True:
+            try:
+                command = self.commands.get_nowait()
+            except queue.Empty:
+                return
+            command()
+    
+    def handle_key(self, key):
+        """Queue a preview window key press. Returns False when the user asked to quit."""
+        zone = self.zone
+        if key == ord('q'):
+            return False
+        elif key == ord('r') and self.tracker:
+            self.submit(self.tracker.reset)
+        elif key == ord('z') and zone:
+            self.submit(self._toggle_zone)
+        elif key == ord('o') and zone:
+            self.submit(self._toggle_overlay)
+        elif key == ord('f') and zone:
+            self.submit(zone.set_fullscreen)
+        return True
+    
+    def _toggle_zone(self):
+        self.zone.enabled = not self.zone.enabled
+        self.zone.visible = self.zone.enabled
+    
+    def _toggle_overlay(self):
+        self.show_overlay = not self.show_overlay
+    
+    def apply_controls(self, control_q):
+        """Queue pending control messages; they are applied on the thread that tracks."""
+        if not control_q.empty():
+            self.submit(lambda: self._apply_control_messages(control_q))
+    
+    def _apply_control_messages(self, control_q):
+        self.zone, self.show_overlay = apply_control_messages(
+            control_q,
+            self.zone,
+            self.src_w,
+            self.src_h,
+            self.args.zone_margin,
+            self.show_overlay,
+            self.tracker,
+        )
+    
+    def emit_stats(self, job):
+        if not self.args.json or time.time() - self.last_stats_time < 0.5:
+            return
+        payload = {
+            "type": "stats",
+            "count": int(job["count"]),
+            "fps": round(self.fps, 1),
+            "mode": "SWEEP" if self.args.sweep else "DET",
+            "score": round(job["detections"].mean_score(), 3),
+        }
+        if self.args.sweep:
+            payload["total"] = int(job["total"])
+            payload["viewport"] = int(job["viewport"])
+            payload["count"] = int(job["total"])
+        if self.scale_ms:
+            payload["scale_ms"] = {f"{scale:g}": {stage: round(ms, 2) for stage, ms in stages.items()}
+                                   for scale, stages in self.scale_ms.items()}
+        if self.controller:
+            payload["preset"] = self.controller.preset
+        if self.controller or self.budget:
+            payload["scale"] = round(self.scale, 3)
+        if self.budget:
+            payload["skip"] = self.skip
+            payload["target_fps"] = self.args.target_fps
+        if self.feed is not None:
+            payload["feed"] = self.feed
+        print(json.dumps(payload), flush=True)
+        self.last_stats_time = time.time()
+    
+    def watch_queue(self, name, q):
+        """Report q's depth in the perf message under name."""
+        self.perf_queues[name] = q
+    
+    def emit_perf(self):
+        """Per-stage p50/p95/p99, queue depths and lost frames, every --perf_interval seconds."""
+        if not self.args.json or self.args.perf_interval <= 0:
+            return
+        if time.time() - self.last_perf_time < self.args.perf_interval:
+            return
+        queues = {name: q.qsize() for name, q in self.perf_queues.items()}
+        if self.grabber:
+            queues["grabber"] = self.grabber.q.qsize()
+        payload = {
+            "type": "perf",
+            "stages": self.perf.summary(),
+            "queues": queues,
+            "dropped": self.dropped_frames + (self.grabber.dropped if self.grabber else 0),
+            "read_failures": self.read_failures,
+        }
+        if self.feed is not None:
+            payload["feed"] = self.feed
+        print(json.dumps(payload), flush=True)
+        self.last_perf_time = time.time()
+    
+    def close(self):
+        if self.grabber:
+            self.grabber.stop()
+        if self.cap is not None:
+            self.cap.release()
+        if self.writer:
+            self.writer.release()
+        if self.streamer:
+            self.streamer.stdin.close()
+            self.streamer.wait()
+        
+        if self.tracker:
+            print(f"\n[Final]{self.label} Total: {self.tracker.total_unique}")
+        summary = self.perf.summary()
+        if summary:
+            print(f"[Perf]{self.label} " + ", ".join(f"{stage} {s['p50']:.1f}/{s['p95']:.1f}/{s['p99']:.1f}"
+                                                     for stage, s in summary.items()) + " ms (p50/p95/p99)")
+        for scale, stages in self.scale_ms.items():
+            print(f"[Multiscale]{self.label} {scale:g}x: " + ", ".join(f"{stage} {ms:.1f} ms" for stage, ms in stages.items()))
+
+
+# =============================================================================
+# STAGED PIPELINE
+# =============================================================================
+
+class PipelineStage:
+    """Worker thread that applies fn to jobs from in_q and passes them on through out_q.
+    
+    A stage without in_q is a source: fn() produces jobs until it returns None.
+    None is forwarded downstream so every later stage shuts down in order.
+    """
+    
+    def __init__(self, name, fn, in_q, out_q, stop_flag):
+        self.name = name
+        self.fn = fn
+        self.in_q = in_q
+        self.out_q = out_q
+        self.stop_flag = stop_flag
+        self.thread = threading.Thread(target=self._worker, name=name, daemon=True)
+    
+    def start(self):
+        self.thread.start()
+        return self
+    
+    def _put(self, job):
+        while not self.stop_flag.is_set():
+            try:
+                self.out_q.put(job, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+    
+    def _worker(self):
+        while not self.stop_flag.is_set():
+            if self.in_q is None:
+                job = self.fn()
+            else:
+                try:
+                    job = self.in_q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if job is not None:
+                    job = self.fn(job)
+            self._put(job)
+            if job is None:
+                break
+    
+    def join(self, timeout=5.0):
+        # A capture stage can sit in a blocking read on a stalled network source;
+        # it is a daemon thread, so give up on it rather than hang shutdown
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            print(f"[Pipeline] {self.name} stage did not stop within {timeout:g}s")
+
+
+def job_roi(job):
+    """Frame region the job's model input covers: its zone ROI or the whole frame."""
+    src_h, src_w = job["frame"].shape[:2]
+    return job["roi"] or (0, 0, src_w, src_h)
+
+
+def add_infer_time(job, start):
+    """Add the ms since start to the job's inference busy time (queue waits excluded)."""
+    job["infer_ms"] = job.get("infer_ms", 0.0) + (time.perf_counter() - start) * 1000
+
+
+def preprocess_job(job, engine):
+    if job["infer"]:
+        start = time.perf_counter()
+        frame = job["frame"]
+        if job["roi"]:
+            x1, y1, x2, y2 = job["roi"]
+            frame = frame[y1:y2, x1:x2]
+        if job["scales"]:
+            job["scale_spans"] = {}
+            job["images"] = engine.preprocess_scales(frame, job["scales"], job["scale_spans"])
+        else:
+            job["image"] = engine.preprocess(frame, job["scale"])
+        job["stage_ms"]["preprocess"] = (time.perf_counter() - start) * 1000
+        add_infer_time(job, start)
+    return job
+
+
+def infer_job(job, engine, session):
+    """Queue the job's forward + NMS; collect_job picks up the result."""
+    if not job["infer"]:
+        return job
+    start = time.perf_counter()
+    try:
+        x1, y1, x2, y2 = job_roi(job)
+        job["spans"] = {}
+        if job["scales"]:
+            job["pending"] = engine.detect_multiscale(
+                job.pop("images"), job["scales"], x2 - x1, y2 - y1,
+                session.ms_threshold, job["nms_kernel"], session.args.max_peaks, job["ms_radius"],
+                job["spans"], job["scale_spans"],
+            )
+        else:
+            job["pending"] = engine.detect_async(
+                job.pop("image"), x2 - x1, y2 - y1, job["scale"],
+                job["threshold"], job["nms_kernel"], session.args.max_peaks, job["spans"],
+            )
+    except Exception as e:
+        print(f"[Error] Inference failed: {e}")
+        # Continue with last known values
+        job["infer"] = False
+    add_infer_time(job, start)
+    return job
+
+
+def collect_job(job):
+    """Wait for the job's queued inference result, if any, and attach it."""
+    pending = job.pop("pending", None)
+    if pending is None:
+        return job
+    start = time.perf_counter()
+    try:
+        x1, y1, _, _ = job_roi(job)
+        job["count"], detections = pending.result()
+        job["detections"] = detections.translate(x1, y1)
+        add_stage_spans([job], job.pop("spans"))
+        if "scale_spans" in job:
+            job["scale_ms"] = {scale: {stage: span.ms() for stage, span in spans.items()}
+                               for scale, spans in job.pop("scale_spans").items()}
+    except Exception as e:
+        print(f"[Error] Inference failed: {e}")
+        job["infer"] = False
+    add_infer_time(job, start)
+    return job
+
+
+def build_stages(session, engine):
+    """(name, fn) for every stage between capture and render, in order.
+    
+    Inference only queues device work, and the track stage waits for each
+    result, so on CUDA the next frame's forward is launched while this one's
+    peaks are still copying back.
+    """
+    return [
+        ("preprocess", lambda job: preprocess_job(job, engine)),
+        ("inference", lambda job: infer_job(job, engine, session)),
+        ("track", lambda job: session.track(collect_job(job))),
+    ]
+
+
+def start_pipeline(session, engine, depth=2):
+    """Start capture, preprocess, inference and track threads joined by bounded queues.
+    
+    Returns (output queue, stop flag, stages). Rendering and encoding stay on the
+    caller's thread, which is also where the preview window has to live.
+    """
+    # The session's own flag, so a capture stuck reconnecting gives up on shutdown too
+    stop_flag = session.stop_flag
+    queues = [queue.Queue(maxsize=depth)]
+    stages = [PipelineStage("capture", session.next_job, None, queues[0], stop_flag)]
+    for name, fn in build_stages(session, engine):
+        queues.append(queue.Queue(maxsize=depth))
+        stages.append(PipelineStage(name, fn, queues[-2], queues[-1], stop_flag))
+    # Each queue is reported under the stage that drains it
+    for stage in stages[1:]:
+        session.watch_queue(stage.name, stage.in_q)
+    session.watch_queue("render", queues[-1])
+    for stage in stages:
+        stage.start()
+    return queues[-1], stop_flag, stages
+
+
+def next_pipeline_output(out_q, stages):
+    """Block for the next finished job; None once the pipeline has drained or died."""
+    while True:
+        try:
+            return out_q.get(timeout=0.5)
+        except queue.Empty:
+            if not any(stage.thread.is_alive() for stage in stages):
+                return None
+
+
+# =============================================================================
+# MULTI-FEED SERVING
+# =============================================================================
+
+def feed_args(args, index):
+    """Copy of args for one feed: its --source plus the matching --output / --save, if any."""
+    feed = argparse.Namespace(**vars(args))
+    feed.source = args.source[index]
+    feed.output = args.output[index] if index < len(args.output) else ''
+    feed.save = args.save[index] if index < len(args.save) else ''
+    return feed
+
+
+def route_control_messages(control_q, feed_queues):
+    """Pass each stdin config on to the feed it names, or to every feed if it names none."""
+    while True:
+        try:
+            config = control_q.get_nowait()
+        except queue.Empty:
+            return
+        
+        feed = config.pop("feed", None)
+        if feed is None:
+            targets = list(feed_queues.values())
+        else:
+            try:
+                targets = [feed_queues[int(feed)]]
+            except (ValueError, KeyError):
+                print(f"[Control] Unknown feed {feed!r}")
+                continue
+        for feed_q in targets:
+            feed_q.put(dict(config))
+
+
+def infer_jobs(jobs, engine, sessions):
+    """Inference stage for one job per feed, with one forward per input shape."""
+    groups = {}
+    for job in jobs:
+        if job["infer"]:
+            key = (tuple(job["image"].shape), job["scale"], job["threshold"], job["nms_kernel"])
+            groups.setdefault(key, []).append(job)
+    
+    for (_, scale, threshold, nms_kernel), group in groups.items():
+        rois = [job_roi(job) for job in group]
+        start = time.perf_counter()
+        timings = {}
+        try:
+            results = engine.detect_batch(
+                [job.pop("image") for job in group], [(x2 - x1, y2 - y1) for x1, y1, x2, y2 in rois],
+                scale, threshold, nms_kernel, sessions[group[0]["feed"]].args.max_peaks, timings=timings,
+            )
+            add_stage_spans(group, timings)
+        except Exception as e:
+            print(f"[Error] Batched inference failed: {e}")
+            for job in group:
+                job["infer"] = False
+            continue
+        for job, (count, detections), (x1, y1, _, _) in zip(group, results, rois):
+            job["count"], job["detections"] = count, detections.translate(x1, y1)
+            add_infer_time(job, start)
+    return jobs
+
+
+def serve_feeds(args, engine, sessions, windows):
+    """Lock-step loop over feeds sharing one engine; sessions and windows are keyed by feed.
+    
+    Each round reads a frame from every live feed, runs their inference as
+    batched forwards, then tracks, renders, writes and emits stats per feed.
+    A feed that ends drops out; the loop stops once none are left.
+    """
+    control_q = start_control_thread()
+    feed_queues = {feed: queue.Queue() for feed in sessions}
+    active = list(sessions.values())
+    
+    while active:
+        route_control_messages(control_q, feed_queues)
+        
+        jobs = []
+        for session in list(active):
+            session.apply_controls(feed_queues[session.feed])
+            job = session.next_job()
+            if job is None:
+                print(f"[Source]{session.label} Finished")
+                active.remove(session)
+                continue
+            jobs.append(preprocess_job(job, engine))
+        
+        infer_jobs(jobs, engine, sessions)
+        
+        for job in jobs:
+            session = sessions[job["feed"]]
+            job = session.track(job)
+            frame = session.render(job)
+            session.write(frame)
+            if windows[session.feed]:
+                cv2.imshow(windows[session.feed], frame)
+            session.emit_stats(job)
+            session.emit_perf()
+        
+        if args.show:
+            key = cv2.waitKey(1) & 0xFF
+            if not all([session.handle_key(key) for session in sessions.values()]):
+                break
+
+
+class InferenceRequest:
+    """One job waiting on the batch scheduler; done is set once detections are attached."""
+    
+    def __init__(self, job, session):
+        self.job = job
+        self.session = session
+        self.done = threading.Event()
+
+
+class BatchScheduler:
+    """Collects inference requests from feed threads into deadline-bounded batches.
+    
+    A batch closes when it holds max_batch requests or deadline_ms after its
+    first request arrived, whichever comes first. Requests are grouped by
+    bucketed input shape and each group runs as one padded forward pass.
+    """
+    
+    def __init__(self, engine, max_batch=8, deadline_ms=15.0, pad_multiple=64):
+        self.engine = engine
+        self.max_batch = max(1, max_batch)
+        self.deadline = deadline_ms / 1000.0
+        self.pad_multiple = max(1, pad_multiple)
+        self.requests = queue.Queue()
+        self.stop_flag = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="scheduler", daemon=True)
+        self.batches = 0
+        self.batched_requests = 0
+    
+    def start(self):
+        self.thread.start()
+        return self
+    
+    def infer(self, job, session):
+        """Queue a preprocessed job and block until its detections are attached."""
+        request = InferenceRequest(job, session)
+        self.requests.put(request)
+        while not request.done.wait(0.1):
+            if self.stop_flag.is_set():
+                job["infer"] = False
+                break
+        return job
+    
+    def _collect(self):
+        try:
+            batch = [self.requests.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.perf_counter() + self.deadline
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+    
+    def _run(self):
+        while not self.stop_flag.is_set():
+            batch = self._collect()
+            if batch:
+                self._dispatch(batch)
+    
+    def _dispatch(self, batch):
+        groups = {}
+        for request in batch:
+            job, session = request.job, request.session
+            h, w = job["image"].shape[2:]
+            key = (bucket_shape(h, w, self.pad_multiple), job["scale"],
+                   job["threshold"], job["nms_kernel"], session.args.max_peaks)
+            groups.setdefault(key, []).append(request)
+        
+        for (_, scale, threshold, nms_kernel, max_peaks), group in groups.items():
+            jobs = [request.job for request in group]
+            rois = [job_roi(job) for job in jobs]
+            timings = {}
+            try:
+                results = self.engine.detect_batch(
+                    [job.pop("image") for job in jobs], [(x2 - x1, y2 - y1) for x1, y1, x2, y2 in rois],
+                    scale, threshold, nms_kernel, max_peaks, self.pad_multiple, timings,
+                )
+                add_stage_spans(jobs, timings)
+                for job, (count, detections), (x1, y1, _, _) in zip(jobs, results, rois):
+                    job["count"], job["detections"] = count, detections.translate(x1, y1)
+            except Exception as e:
+                print(f"[Error] Batched inference failed: {e}")
+                for job in jobs:
+                    job["infer"] = False
+            finally:
+                self.batches += 1
+                self.batched_requests += len(group)
+                for request in group:
+                    request.done.set()
+    
+    def stop(self):
+        self.stop_flag.set()
+        self.thread.join(2.0)
+        if self.batches:
+            print(f"[Scheduler] {self.batches} batches, {self.batched_requests / self.batches:.2f} frames per batch")
+
+
+def scheduled_feed_job(session, engine, scheduler):
+    """Source for a feed thread: read, preprocess, infer via the scheduler and track one frame."""
+    job = session.next_job()
+    if job is None:
+        print(f"[Source]{session.label} Finished")
+        return None
+    job = preprocess_job(job, engine)
+    if job["infer"]:
+        start = time.perf_counter()
+        scheduler.infer(job, session)
+        add_infer_time(job, start)
+    return session.track(job)
+
+
+def serve_feeds_scheduled(args, engine, sessions, windows):
+    """Feeds on their own threads, inference batched across them by a BatchScheduler.
+    
+    Unlike serve_feeds, a slow or stalled feed does not hold the others back.
+    Rendering, encoding and the preview stay on this thread; key presses and
+    control messages reach each feed thread through its session's commands.
+    """
+    scheduler = BatchScheduler(engine, args.max_batch, args.batch_deadline_ms, args.bucket_multiple).start()
+    for session in sessions.values():
+        session.watch_queue("scheduler", scheduler.requests)
+    out_q = queue.Queue(maxsize=2 * len(sessions))
+    # Each feed thread stops on its session's flag, which also cuts a reconnect short
+    stages = [
+        PipelineStage(f"feed{feed}", lambda session=session: scheduled_feed_job(session, engine, scheduler),
+                      None, out_q, session.stop_flag).start()
+        for feed, session in sessions.items()
+    ]
+    control_q = start_control_thread()
+    feed_queues = {feed: queue.Queue() for feed in sessions}
+    remaining = len(stages)
+    
+    try:
+        while remaining:
+            route_control_messages(control_q, feed_queues)
+            for feed, session in sessions.items():
+                session.apply_controls(feed_queues[feed])
+            
+            try:
+                job = out_q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if job is None:
+                remaining -= 1
+                continue
+            
+            session = sessions[job["feed"]]
+            frame = session.render(job)
+            session.write(frame)
+            if windows[session.feed]:
+                cv2.imshow(windows[session.feed], frame)
+                key = cv2.waitKey(1) & 0xFF
+                if not all([s.handle_key(key) for s in sessions.values()]):
+                    break
+            session.emit_stats(job)
+            session.emit_perf()
+    finally:
+        for session in sessions.values():
+            session.stop_flag.set()
+        scheduler.stop()
+        # Sessions are closed by the caller, so no feed thread may still be reading
+        for stage in stages:
+            stage.join()
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+def staging_slots(args):
+    """Preprocessed images that can be alive at once, so GPUPreprocessor never reuses one early."""
+    if len(args.source) > 1:
+        # One in flight per feed, plus the one being written
+        return len(args.source) + 1
+    if args.pipeline:
+        # A full queue, one blocked on put, one in inference, one being written
+        return max(1, args.pipeline_depth) + 3
+    return 2
+
+
+def setup_window(window_name, session, args):
+    """Create the preview window for a session and hook its zone up to the mouse."""
+    cv2.namedWindow(window_name, cv2.WINDOW_NORMAL)
+    
+    # Parse window_size argument
+    try:
+        display_w, display_h = map(int, args.window_size.split('x'))
+        display_w = min(display_w, session.src_w)
+        display_h = min(display_h, session.src_h)
+    except:
+        print(f"[Warning] Invalid window_size '{args.window_size}', using default")
+        display_w = min(session.src_w, 1280)
+        display_h = min(session.src_h, 720)
+    
+    cv2.resizeWindow(window_name, display_w, display_h)
+    
+    if session.zone:
+        session.zone.set_display_scale(display_w, display_h)
+        cv2.setMouseCallback(window_name, session.zone.on_mouse)
+    return window_name
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Crowd Counter with Draggable Zone')
+    
+    parser.add_argument('--source', '-s', required=True, nargs='+',
+                        help='Video source; several sources share one model in multi-feed mode')
+    parser.add_argument('--batch_deadline_ms', type=float, default=15.0,
+                        help='Multi-feed: max wait to fill an inference batch (0 = lock-step rounds)')
+    parser.add_argument('--max_batch', type=int, default=8, help='Multi-feed: max frames per inference batch')
+    parser.add_argument('--bucket_multiple', type=int, default=64,
+                        help='Multi-feed: pad batched inputs up to multiples of this many pixels')
+    parser.add_argument('--output', '-o', nargs='*', default=[], help='Stream output URL (one per source)')
+    parser.add_argument('--save', nargs='*', default=[], help='Save to file (one per source)')
+    parser.add_argument('--model', '-m', default='', help='Model path')
+    parser.add_argument('--preset', '-p', default='accurate', choices=list(PRESETS.keys()))
+    parser.add_argument('--show', action='store_true', help='Show preview')
+    parser.add_argument('--json', action='store_true', help='JSON output')
+    
+    parser.add_argument('--sweep', action='store_true', help='Enable sweep mode')
+    parser.add_argument('--max_dist', type=int, default=50)
+    parser.add_argument('--memory', type=int, default=60)
+    parser.add_argument('--min_hits', type=int, default=3)
+    parser.add_argument('--assoc', default='greedy', choices=list(ASSOCIATION_BACKENDS.keys()),
+                        help='Track association: nearest-first greedy or optimal assignment')
+    
+    parser.add_argument('--zone', action='store_true', help='Enable draggable zone')
+    parser.add_argument('--zone_margin', type=int, default=80)
+    parser.add_argument('--zone_infer', action='store_true',
+                        help='Run the model only on the zone (tracking rect in sweep mode) instead of the whole frame')
+    parser.add_argument('--zone_infer_pad', type=int, default=32, help='Context pixels kept around the zone crop')
+    parser.add_argument('--zone_overlay', action='store_true')
+    parser.add_argument('--zone_rect_norm', type=str, default='', help='Normalized zone x1,y1,x2,y2 from UI')
+    parser.add_argument('--hide_zone', action='store_true', help='Use zone for filtering without drawing it')
+    parser.add_argument('--hide_hud', action='store_true', help='Do not draw count/FPS/help text on frames')
     
     parser.add_argument('--threshold', '-t', type=float)
     parser.add_argument('--scale', type=float)
     parser.add_argument('--nms', type=int)
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Switch scale/threshold/nms between the sparse, accurate, dense and ultra_dense '
+                             'presets by measured density and latency')
+    parser.add_argument('--adaptive_min_fps', type=float, default=15.0,
+                        help='Adaptive: lower the scale while inference cannot keep up with this rate')
+    parser.add_argument('--target_fps', type=float, default=0,
+                        help='Latency budget: adjust scale, then --skip, to hold this FPS (0 = off)')
+    parser.add_argument('--min_scale', type=float, default=0.3, help='Latency budget: lowest scale')
+    parser.add_argument('--max_scale', type=float, default=1.0, help='Latency budget: highest scale')
+    parser.add_argument('--max_skip', type=int, default=4, help='Latency budget: largest skip interval')
+    parser.add_argument('--multiscale', action='store_true',
+                        help='Run every frame at several scales in one batch and fuse the peaks')
+    parser.add_argument('--ms_scales', default='0.75,1.0,1.25', help='Multi-scale: comma-separated multiples of --scale')
+    parser.add_argument('--ms_threshold', type=float, help='Multi-scale: peak threshold (default: --threshold)')
+    parser.add_argument('--ms_nms_radius', type=int,
+                        help='Multi-scale: frame-pixel radius that merges one head across scales (default: from --nms)')
+    parser.add_argument('--max_peaks', type=int, default=4096, help='Peak buffer size copied back from the GPU per frame')
     parser.add_argument('--box_size', type=int, default=14)
     parser.add_argument('--box_thickness', type=int, default=2)
     parser.add_argument('--dot', action='store_true', help='Display dots instead of boxes')
+    parser.add_argument('--runtime', default='auto', choices=['auto', 'eager', 'torchscript', 'onnx'],
+                        help='Model runtime (auto picks from the --model extension: .onnx, .ts, else eager)')
     parser.add_argument('--gpu', default='0')
+    parser.add_argument('--device', default='auto', choices=['auto', 'cuda', 'cpu'],
+                        help='Inference device (auto picks CUDA when available)')
+    parser.add_argument('--precision', choices=list(PRECISION_DTYPES.keys()),
+                        help='Autocast precision (default: per preset on CUDA, fp32 on CPU)')
+    parser.add_argument('--channels_last', nargs='?', const='on', choices=['on', 'off'],
+                        help='Run the model in channels-last memory format (default: per preset on CUDA)')
+    parser.add_argument('--compile', choices=COMPILE_MODES,
+                        help='torch.compile mode for eager models (default: per preset, off)')
+    parser.add_argument('--precision_check', type=float, default=0.03,
+                        help='Fall back to fp32 if a startup frame counts more than this fraction off fp32 (0 = skip)')
+    parser.add_argument('--tile', type=int, default=0,
+                        help='Tiled inference: tile size in model pixels, after --scale (0 = whole frame)')
+    parser.add_argument('--tile_overlap', type=int, default=64, help='Tile overlap in model pixels')
+    parser.add_argument('--tile_batch', type=int, default=4, help='Tiles per forward pass (bounds memory)')
+    parser.add_argument('--input_buckets', default='ladder', choices=['off', 'ladder'],
+                        help='Pad inputs to a few bucketed shapes so new sizes do not trigger cudnn re-tuning')
+    parser.add_argument('--warmup_runs', type=int, default=2,
+                        help='Dummy forwards per input shape at startup (0 = no warm-up)')
+    parser.add_argument('--deploy', action='store_true', help='Fold BatchNorm into the convolutions after loading')
+    parser.add_argument('--quantized', action='store_true', help='--model is an INT8 checkpoint from quantize_model.py')
+    parser.add_argument('--cpu_threads', type=int, default=0, help='Intra-op threads for CPU inference (0 = all cores)')
     parser.add_argument('--nvenc', action='store_true')
     parser.add_argument('--skip', type=int, default=1)
+    parser.add_argument('--propagate', default='off', choices=['off', 'velocity', 'flow'],
+                        help='Move overlays on skipped frames by track velocity or optical flow')
     parser.add_argument('--queue_size', type=int, default=1)
+    parser.add_argument('--perf_interval', type=float, default=1.0,
+                        help='Seconds between JSON perf messages with per-stage latencies (0 = off)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Run capture, preprocess, inference and tracking on separate threads')
+    parser.add_argument('--pipeline_depth', type=int, default=2, help='Frames buffered between pipeline stages')
+    parser.add_argument('--cuda_streams', default='on', choices=['on', 'off'],
+                        help='Overlap uploads, compute and peak downloads on separate CUDA streams')
     parser.add_argument('--stream_fps', type=int, default=24)
     parser.add_argument('--stream_bitrate', default='5000k')
     parser.add_argument('--stream_codec', default='libx264')
@@ -1382,6 +3786,9 @@ def main():
     print("Crowd Counter" + (" - SWEEP MODE" if args.sweep else ""))
     print("=" * 50)
     print(f"Preset: {args.preset}, Scale: {scale}, Threshold:  {threshold}")
+    if args.adaptive:
+        print(f"[Adaptive] Density presets {'/'.join(name for name, _ in ADAPTIVE_TIERS)}, "
+              + ("scale from --target_fps" if args.target_fps > 0 else f"min {args.adaptive_min_fps:g} inferences/s"))
     
     # Find model
     model_path = args.model
@@ -1395,291 +3802,166 @@ def main():
         print("[ERROR] Model not found!")
         return
     
+    # Pick device and precision
+    if args.device != 'cpu':
+        # Must be set before CUDA is first queried
+        os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+    device = resolve_device(args.device)
+    if args.quantized and (device != 'cpu' or args.precision not in (None, 'fp32')):
+        print("[Model] INT8 kernels are CPU-only, using cpu/fp32")
+        device, args.precision = 'cpu', 'fp32'
+    precision, channels_last, compile_mode = precision_policy(args, preset, device)
+    if device == 'cpu':
+        print(f"[Model] CPU threads: {configure_cpu_threads(args.cpu_threads)}")
+    print(f"[Model] Device: {device}, precision: {precision}" + (", channels-last" if channels_last else "")
+          + (f", compile: {compile_mode}" if compile_mode != 'off' else ""))
+    
     # Load model
+    runtime = resolve_runtime(args.runtime, model_path)
     try:
-        model = load_model(model_path, args.gpu)
-        preprocessor = GPUPreprocessor('cuda')
+        if runtime == 'eager':
+            model = load_model(model_path, args.gpu, device, args.quantized, args.deploy)
+        else:
+            model = load_exported_model(model_path, runtime, device, args.cpu_threads)
+        engine = InferenceEngine(model, device, precision, channels_last,
+                                 args.tile, args.tile_overlap, args.tile_batch, args.input_buckets == 'ladder',
+                                 staging_slots(args), args.cuda_streams == 'on')
     except Exception as e: 
         print(f"[ERROR] {e}")
         return
     
-    # Open source
-    print(f"[Source] Opening: {args.source}")
-    cap = cv2.VideoCapture(args.source, cv2.CAP_FFMPEG) if args.source.lower().startswith(("rtsp://", "rtmp://")) else cv2.VideoCapture(args.source)
-    
-    if not cap.isOpened():
-        print("[ERROR] Cannot open source")
-        return
-    
-    ret, frame = cap.read()
-    if not ret:
-        print("[ERROR] Cannot read from source")
+    multi = len(args.source) > 1
+    if args.multiscale and multi:
+        print("[Multiscale] --multiscale is single-feed only; multi-feed mode batches across feeds instead")
+        args.multiscale = False
+    if args.multiscale:
+        try:
+            print(f"[Multiscale] Scales: {', '.join(f'{s:g}' for s in multiscale_scales(args.ms_scales, scale))}")
+        except ValueError as e:
+            print(f"[ERROR] {e}")
+            return
+    sessions = []
+    for index, source in enumerate(args.source):
+        session = FeedSession(feed_args(args, index), source, scale, threshold, nms_kernel,
+                              feed=index if multi else None)
+        if session.open():
+            sessions.append(session)
+        elif not multi:
+            return
+        else:
+            print(f"[Source][{index}] Skipping feed")
+            session.close()
+    if not sessions:
+        print("[ERROR] No feed could be opened")
         return
     
-    src_h, src_w = frame.shape[:2]
-    print(f"[Source] Resolution:  {src_w}x{src_h}")
-    
-    out_w, out_h = src_w, src_h
-    if args.stream_width > 0 and args.stream_height > 0:
-        out_w, out_h = args.stream_width, args.stream_height
-    elif args.stream_width > 0:
-        out_w = args.stream_width
-        out_h = max(1, int(src_h * (out_w / src_w)))
-    elif args.stream_height > 0:
-        out_h = args.stream_height
-        out_w = max(1, int(src_w * (out_h / src_h)))
-    
-    # Setup zone
-    zone = DraggableZone(src_w, src_h, margin=args.zone_margin) if args.zone else None
-    if zone and args.zone_rect_norm:
+    # Check the chosen precision against fp32 on a real frame before serving
+    if compile_mode != 'off':
+        engine.compile(compile_mode)
+    if args.precision_check > 0 and (precision != 'fp32' or compile_mode != 'off'):
+        session = sessions[0]
         try:
-            apply_zone_rect(zone, args.zone_rect_norm, src_w, src_h)
+            engine.self_check(session.probe_frame, session.scale, session.threshold, session.nms_kernel,
+                              args.max_peaks, args.precision_check)
         except Exception as e:
-            print(f"[Zone] Invalid zone_rect_norm '{args.zone_rect_norm}': {e}")
-    show_overlay = args.zone_overlay
-    
-    # Setup streamer
-    streamer = create_streamer(
-        args.output,
-        out_w,
-        out_h,
-        fps=args.stream_fps,
-        bitrate=args.stream_bitrate,
-        codec=args.stream_codec,
-        preset=args.stream_preset,
-        use_nvenc=args.nvenc,
-    ) if args.output else None
-    
-    # Setup writer
-    writer = cv2.VideoWriter(args.save, cv2.VideoWriter_fourcc(*'mp4v'), 24, (src_w, src_h)) if args.save else None
-    
-    # Setup grabber
-    grabber = None
-    if args.source.lower().startswith(("rtsp://", "rtmp://")):
-        cap.release()
-        cap = cv2.VideoCapture(args.source, cv2.CAP_FFMPEG)
-        grabber = FrameGrabber(cap, queue_size=max(1, args.queue_size)).start()
-    
-    # Setup tracker
-    tracker = ImprovedSweepTracker(max_distance=args.max_dist, max_age=10, max_lost_age=args.memory, min_hits=args.min_hits) if args.sweep else None
+            print(f"[Precision] Check skipped: {e}")
+    
+    # Tune every input shape the feeds will produce before the first real frame
+    batch_sizes = range(1, min(args.max_batch, len(sessions)) + 1) if multi else (1,)
+    warmup_scales = [sessions[0].scale]
+    if args.target_fps > 0:
+        warmup_scales = sorted({s for session in sessions for s in session.budget.scales})
+    elif args.adaptive:
+        warmup_scales = sessions[0].controller.scales()
+    if args.multiscale:
+        # Each scale runs its own single-image forward
+        warmup_scales = sorted({s for base in warmup_scales for s in multiscale_scales(args.ms_scales, base)})
+        batch_sizes = (1,)
+    rois = [roi for roi in (session.zone_roi() for session in sessions) if roi]
+    try:
+        engine.warmup([(session.src_w, session.src_h) for session in sessions], warmup_scales, batch_sizes,
+                      args.warmup_runs, [(x2 - x1, y2 - y1) for x1, y1, x2, y2 in rois])
+    except Exception as e:
+        print(f"[Warmup] Skipped: {e}")
+    
+    if multi:
+        # Feeds keep their index so stats and control messages stay addressable
+        sessions = {session.feed: session for session in sessions}
+        windows = {feed: setup_window(f"Crowd Counter [{feed}]", session, args) if args.show else None
+                   for feed, session in sessions.items()}
+        if args.pipeline:
+            print("[Pipeline] --pipeline is single-feed only; multi-feed mode runs its own threads")
+        print(f"\n[Serve] {len(sessions)} feeds on one model\n")
+        try:
+            if args.batch_deadline_ms > 0:
+                serve_feeds_scheduled(args, engine, sessions, windows)
+            else:
+                serve_feeds(args, engine, sessions, windows)
+        except KeyboardInterrupt:
+            print("\n[INFO] Stopped")
+        finally:
+            for session in sessions.values():
+                session.close()
+            if args.show:
+                cv2.destroyAllWindows()
+            print("[Done]")
+        return
+    
+    session = sessions[0]
     
     # Setup window
-    window_name = "Crowd Counter"
-    if args.show:
-        cv2.namedWindow(window_name, cv2.WINDOW_NORMAL)
-        
-        # Parse window_size argument
-        try:
-            display_w, display_h = map(int, args.window_size.split('x'))
-            display_w = min(display_w, src_w)
-            display_h = min(display_h, src_h)
-        except:
-            print(f"[Warning] Invalid window_size '{args.window_size}', using default")
-            display_w = min(src_w, 1280)
-            display_h = min(src_h, 720)
-        
-        cv2.resizeWindow(window_name, display_w, display_h)
-        
-        if zone:
-            zone.set_display_scale(display_w, display_h)
-            cv2.setMouseCallback(window_name, zone.on_mouse)
+    window_name = setup_window("Crowd Counter", session, args) if args.show else None
     
     print("\n[Controls] Q=Quit R=Reset Z=Zone O=Overlay F=Fullscreen\n")
     
-    # Main loop
-    fps, fps_start, fps_count = 0, time.time(), 0
-    frame_num = 0
-    last_count, last_kpoint = 0, np.zeros((src_h, src_w), dtype=np.float32)
-    last_viewport, last_total, last_positions = 0, 0, np.array([])
-    last_stats_time = 0
     control_q = start_control_thread()
-    consecutive_failures = 0
-    max_consecutive_failures = 10
-    is_stream = args.source.lower().startswith(("rtsp://", "rtmp://", "http://"))
+    stages, stop_flag = [], None
+    if args.pipeline:
+        out_q, stop_flag, stages = start_pipeline(session, engine, depth=max(1, args.pipeline_depth))
+        next_job = lambda: next_pipeline_output(out_q, stages)
+    else:
+        steps = [fn for _, fn in build_stages(session, engine)]
+        
+        def next_job():
+            job = session.next_job()
+            for fn in steps:
+                if job is None:
+                    break
+                job = fn(job)
+            return job
     
+    # Main loop: render and encode on this thread, everything upstream in next_job
     try:
         while True:
-            zone, show_overlay = apply_control_messages(
-                control_q,
-                zone,
-                src_w,
-                src_h,
-                args.zone_margin,
-                show_overlay,
-                tracker,
-            )
-
-            # Fix: Don't call cap.read() twice - it skips frames!
-            if grabber:
-                frame = grabber.read(timeout=2.0)
-            else:
-                ret, frame = cap.read()
-                if not ret:
-                    frame = None
-            
-            if frame is None:
-                consecutive_failures += 1
-                
-                # Try to reconnect for streams
-                if is_stream and consecutive_failures < max_consecutive_failures:
-                    print(f"[Warning] Frame read failed ({consecutive_failures}/{max_consecutive_failures})")
-                    
-                    # Attempt reconnection
-                    if grabber:
-                        grabber.stop()
-                    cap.release()
-                    
-                    new_cap, new_frame = reconnect_stream(args.source)
-                    if new_cap and new_frame:
-                        cap = new_cap
-                        if grabber:
-                            grabber = FrameGrabber(cap, queue_size=max(1, args.queue_size)).start()
-                        frame = new_frame
-                        consecutive_failures = 0
-                        print("[Info] Reconnected successfully, resuming...")
-                    else:
-                        print("[Error] Reconnection failed")
-                        time.sleep(1.0)
-                        continue
-                else:
-                    print("[INFO] Stream ended or too many failures")
-                    break
-            else:
-                consecutive_failures = 0
-            
-            if frame.shape[: 2] != (src_h, src_w):
-                frame = cv2.resize(frame, (src_w, src_h))
-            
-            frame_num += 1
-            fps_count += 1
-            
-            if time.time() - fps_start >= 1.0:
-                fps = fps_count / (time.time() - fps_start)
-                fps_count, fps_start = 0, time.time()
-            
-            # Process
-            if frame_num % args.skip == 0:
-                try:
-                    last_count, last_kpoint = run_inference(model, preprocessor, frame, scale, threshold, nms_kernel)
-                    
-                    zone_rect = zone.get_rect() if zone and zone.enabled else None
-                    if zone and zone.enabled and not args.sweep:
-                        last_kpoint = zone.filter_points(last_kpoint)
-                        last_count = int(np.sum(last_kpoint))
-                    
-                    if tracker: 
-                        ys, xs = np.nonzero(last_kpoint)
-                        points = np.column_stack((xs, ys)) if len(xs) > 0 else np.array([])
-                        if zone_rect is not None:
-                            points = filter_points_to_tracking_rect(points, zone_rect, src_w, src_h)
-                        last_viewport, last_total, last_positions = tracker.update(points, frame.shape, zone_rect)
-                except Exception as e:
-                    print(f"[Error] Inference failed: {e}")
-                    # Continue with last known values
-            
-            # Draw
-            if zone and show_overlay and not args.hide_zone:
-                zone.draw_overlay(frame, alpha=0.3)
+            session.apply_controls(control_q)
             
-            if args.dot:
-                if args.sweep:
-                    draw_tracked_dots(frame, last_positions, radius=max(1, args.box_size // 2))
-                else:
-                    draw_dots(frame, last_kpoint, radius=max(1, args.box_size // 2))
-            else:
-                if args.sweep:
-                    draw_tracked_points(frame, last_positions, args.box_size, args.box_thickness)
-                else:
-                    draw_boxes(frame, last_kpoint, args.box_size, args.box_thickness)
-            
-            if zone and zone.visible and not args.hide_zone:
-                zone.draw(frame)
-            
-            info = {"title": "SWEEP MODE" if args.sweep else "COUNT",
-                    "total": last_total if args.sweep else last_count,
-                    "viewport": last_viewport} if args.sweep else {"title":  "COUNT", "total": last_count}
-            info["fps"] = fps
-            
-            if not args.hide_hud:
-                draw_info_panel(frame, info)
-                draw_help(frame)
-            
-            # Output
-            if streamer:
-                try:
-                    stream_frame = frame
-                    if (out_w, out_h) != (src_w, src_h):
-                        stream_frame = cv2.resize(frame, (out_w, out_h))
-                    streamer.stdin.write(stream_frame.tobytes())
-                except Exception as e:
-                    print(f"[Error] Streamer write failed: {e}, attempting to recreate...")
-                    try:
-                        streamer.stdin.close()
-                        streamer.wait()
-                    except:
-                        pass
-                    streamer = create_streamer(
-                        args.output,
-                        out_w,
-                        out_h,
-                        fps=args.stream_fps,
-                        bitrate=args.stream_bitrate,
-                        codec=args.stream_codec,
-                        preset=args.stream_preset,
-                        use_nvenc=args.nvenc,
-                    )
+            job = next_job()
+            if job is None:
+                break
             
-            if writer:
-                writer.write(frame)
+            frame = session.render(job)
+            session.write(frame)
             
             if args.show:
                 cv2.imshow(window_name, frame)
                 key = cv2.waitKey(1) & 0xFF
-                
-                if key == ord('q'):
+                if not session.handle_key(key):
                     break
-                elif key == ord('r') and tracker:
-                    tracker.reset()
-                elif key == ord('z') and zone:
-                    zone.enabled = not zone.enabled
-                    zone.visible = zone.enabled
-                elif key == ord('o') and zone:
-                    show_overlay = not show_overlay
-                elif key == ord('f') and zone:
-                    zone.set_fullscreen()
             
-            # JSON
-            if args.json and time.time() - last_stats_time >= 0.5:
-                payload = {
-                    "type": "stats",
-                    "count": int(last_count),
-                    "fps": round(fps, 1),
-                    "mode": "SWEEP" if args.sweep else "DET"
-                }
-                if args.sweep:
-                    payload["total"] = int(last_total)
-                    payload["viewport"] = int(last_viewport)
-                    payload["count"] = int(last_total)
-                print(json.dumps(payload), flush=True)
-                last_stats_time = time.time()
+            session.emit_stats(job)
+            session.emit_perf()
     
     except KeyboardInterrupt:
         print("\n[INFO] Stopped")
     
     finally:
-        if grabber:
-            grabber.stop()
-        cap.release()
-        if writer:
-            writer.release()
-        if streamer:
-            streamer.stdin.close()
-            streamer.wait()
+        if stop_flag is not None:
+            stop_flag.set()
+            for stage in stages:
+                stage.join()
+        session.close()
         if args.show:
             cv2.destroyAllWindows()
-        
-        if tracker:
-            print(f"\n[Final] Total: {tracker.total_unique}")
         print("[Done]")
 
 
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Post-training static INT8 quantization of the HRNet counter.
+
+Fuses Conv+BN(+ReLU), calibrates activation ranges on a directory of frames
+(preprocessed the way the live counter does at --scale), converts and saves a
+checkpoint for `live_feed_sweep.py --quantized`. --report compares count MAE
+and latency of the float and INT8 models on the test.py validation list.
+
+    python quantize_model.py --model models/model.pth --calib_dir frames/ --scale 0.5
+    python quantize_model.py --model models/model.pth --calib_dir frames/ --report --dataset ShanghaiA
+"""
+
+import argparse
+import glob
+import math
+import os
+import time
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torchvision import transforms
+
+from live_feed_sweep import SCRIPT_DIR, GPUPreprocessor, load_model
+
+# Same validation lists as test.py
+VAL_LISTS = {
+    'ShanghaiA': './npydata/ShanghaiA_test.npy',
+    'ShanghaiB': './npydata/ShanghaiB_test.npy',
+    'UCF_QNRF': './npydata/qnrf_test.npy',
+    'JHU': './npydata/jhu_test.npy',
+    'NWPU': './npydata/nwpu_val.npy',
+}
+
+IMAGE_EXTENSIONS = ('*.jpg', '*.jpeg', '*.png', '*.bmp')
+
+
+def calibration_frames(calib_dir, limit):
+    paths = sorted(p for ext in IMAGE_EXTENSIONS for p in glob.glob(os.path.join(calib_dir, ext)))
+    if not paths:
+        raise FileNotFoundError(f"No calibration images in {calib_dir}")
+    # Spread the picks over the whole directory (frames dumped from a video are sequential)
+    step = max(1, len(paths) // limit)
+    return paths[::step][:limit]
+
+
+def quantize(model, frame_paths, scale, backend):
+    from Networks.HR_Net.seg_hrnet import prepare_static_quantization
+
+    preprocessor = GPUPreprocessor('cpu')
+    prepare_static_quantization(model, backend)
+    with torch.no_grad():
+        for i, path in enumerate(frame_paths):
+            model(preprocessor(cv2.imread(path), scale))
+            print(f"\r[Calibrate] {i + 1}/{len(frame_paths)}", end='')
+    print()
+    return torch.ao.quantization.convert(model, inplace=True)
+
+
+def lmds_count(fidt):
+    """Peak count exactly as test.py's LMDS_counting."""
+    fidt_max = torch.max(fidt).item()
+    if fidt_max < 0.1:
+        return 0
+    keep = F.max_pool2d(fidt, (3, 3), stride=1, padding=1)
+    peaks = (keep == fidt) & (fidt >= 100.0 / 255.0 * fidt_max) & (fidt > 0)
+    return int(peaks.sum().item())
+
+
+def evaluate(models, dataset, limit):
+    """Per-model MAE/MSE against ground truth plus mean latency on the validation list."""
+    from image import load_data_fidt
+
+    with open(VAL_LISTS[dataset], 'rb') as f:
+        val_list = np.load(f).tolist()
+    if limit:
+        val_list = val_list[:limit]
+
+    transform = transforms.Compose([
+        transforms.ToTensor(), transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+    ])
+    counts = {name: [] for name in models}
+    timings = {name: [] for name in models}
+    gt_counts = []
+    for i, img_path in enumerate(val_list):
+        img, _, kpoint = load_data_fidt(img_path, None, train=False)
+        image = transform(img).unsqueeze(0)
+        gt_counts.append(float(np.sum(kpoint)))
+        for name, model in models.items():
+            start = time.perf_counter()
+            with torch.no_grad():
+                fidt = model(image)
+            timings[name].append((time.perf_counter() - start) * 1000)
+            counts[name].append(lmds_count(fidt))
+        print(f"\r[Eval] {i + 1}/{len(val_list)}", end='')
+    print()
+
+    gt_counts = np.array(gt_counts)
+    report = {}
+    for name in models:
+        errors = np.array(counts[name]) - gt_counts
+        report[name] = {
+            'mae': float(np.mean(np.abs(errors))),
+            'mse': math.sqrt(float(np.mean(errors ** 2))),
+            'ms': float(np.mean(timings[name])),
+            'counts': np.array(counts[name]),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Static INT8 quantization for HRNet')
+    parser.add_argument('--model', '-m', required=True, help='Float checkpoint (.pth)')
+    parser.add_argument('--calib_dir', required=True, help='Directory of calibration frames')
+    parser.add_argument('--calib_frames', type=int, default=64)
+    parser.add_argument('--scale', type=float, default=0.5, help='Live --scale to calibrate at')
+    parser.add_argument('--backend', default='x86', choices=['x86', 'fbgemm', 'qnnpack'],
+                        help='Quantized engine (qnnpack for ARM)')
+    parser.add_argument('--output', '-o', default='', help='Output path (default: <model>_int8.pth)')
+    parser.add_argument('--report', action='store_true', help='Compare float vs INT8 on the validation list')
+    parser.add_argument('--dataset', default='ShanghaiA', choices=list(VAL_LISTS.keys()))
+    parser.add_argument('--eval_limit', type=int, default=0, help='Evaluate on the first N images (0 = all)')
+    args = parser.parse_args()
+
+    model_path = os.path.abspath(args.model)
+    output = os.path.abspath(args.output or os.path.splitext(args.model)[0] + '_int8.pth')
+    frame_paths = calibration_frames(os.path.abspath(args.calib_dir), args.calib_frames)
+
+    # get_seg_model and the npydata lists are relative to the crowd_counter folder
+    os.chdir(SCRIPT_DIR)
+    quantized = quantize(load_model(model_path, device='cpu'), frame_paths, args.scale, args.backend)
+    torch.save({
+        'state_dict': quantized.state_dict(),
+        'quantized': True,
+        'backend': args.backend,
+        'calib_frames': len(frame_paths),
+        'scale': args.scale,
+    }, output)
+    print(f"[Quantize] Wrote {output} ({os.path.getsize(output) / 1e6:.1f} MB)")
+
+    if args.report:
+        models = {'float': load_model(model_path, device='cpu'), 'int8': quantized}
+        report = evaluate(models, args.dataset, args.eval_limit)
+        print(f"\n{'model':>6} {'MAE':>8} {'MSE':>8} {'ms/img':>8}")
+        for name, r in report.items():
+            print(f"{name:>6} {r['mae']:>8.2f} {r['mse']:>8.2f} {r['ms']:>8.1f}")
+        drift = np.mean(np.abs(report['int8']['counts'] - report['float']['counts']))
+        print(f"\nINT8 vs float count MAE: {drift:.2f}, speedup: {report['float']['ms'] / report['int8']['ms']:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -250,6 +250,9 @@ function startCrowdCounter(config) {
   if (config. detect_interval !== undefined) {
     args.push("--detect_interval", config.detect_interval. toString());
   }
+  if (config.target_fps) {
+    args.push("--target_fps", config.target_fps.toString());
+  }
   if (config.max_drift !== undefined) {
     args.push("--max_drift", config.max_drift.toString());
   }
@@ -368,8 +371,17 @@ function startCrowdCounter(config) {
                 viewport: msg.viewport,
                 fps: msg.fps,
                 mode: msg.mode,
+                scale_ms: msg.scale_ms,
+                preset: msg.preset,
+                scale: msg.scale,
+                skip: msg.skip,
+                target_fps: msg.target_fps,
               });
             }
+          } else if (msg.type === "perf") {
+            if (mainWindow && !mainWindow.isDestroyed()) {
+              mainWindow.webContents.send("crowd-counter-perf", msg);
+            }
           } else if (msg.type === "error") {
             console.error(`[CrowdCounter] Error: ${msg.message}`);
             if (mainWindow && !mainWindow.isDestroyed()) {
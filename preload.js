@@ -75,5 +75,8 @@ contextBridge.exposeInMainWorld("electronAPI", {
   onCrowdCounterLog: (callback) => {
     ipcRenderer.on("crowd-counter-log", (event, log) => callback(log));
   },
+  onCrowdCounterPerf: (callback) => {
+    ipcRenderer.on("crowd-counter-perf", (event, perf) => callback(perf));
+  },
   
 });